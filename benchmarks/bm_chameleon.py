@@ -1,4 +1,4 @@
-#!/usr/bin/python2
+#!/usr/bin/env python
 
 """
 Benchmark for test the performance of Chameleon page template engine.
@@ -24,6 +24,14 @@ sys.path.insert(0, relative('..', 'src'))
 # Chameleon imports
 from chameleon import PageTemplate
 
+try:
+    xrange
+except NameError:
+    xrange = range
+    EXTRA_BUILTINS = {'xrange': range}
+else:
+    EXTRA_BUILTINS = {}
+
 
 LOREM_IPSUM = """Quisque lobortis hendrerit posuere. Curabitur
 aliquet consequat sapien molestie pretium. Nunc adipiscing luc
@@ -98,7 +106,7 @@ velit. Fusce dapibus ligula quis lectus ultricies tempor. Pellente</p>
 def test_mako(count):
     template = PageTemplate(CONTENT_TEMPLATE)
     base = PageTemplate(BASE_TEMPLATE)
-    page = PageTemplate(PAGE_TEMPLATE)
+    page = PageTemplate(PAGE_TEMPLATE, extra_builtins=EXTRA_BUILTINS)
 
     table = [xrange(150) for i in xrange(150)]
     paragraphs = xrange(50)
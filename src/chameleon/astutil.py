@@ -201,6 +201,10 @@ class Comment(Node):
     stmt = None
     space = ""
 
+    # A ``(filename, line, column, text)`` tuple which records the
+    # template source location of the code that follows
+    location = None
+
 
 class ASTCodeGenerator(object):
     """General purpose base class for AST transformations.
@@ -2,10 +2,24 @@ import unittest
 import time
 import os
 import re
+import sys
+import json
+import math
+import optparse
 from .utils import text_
+from .utils import read_bytes
 
 re_amp = re.compile(r'&(?!([A-Za-z]+|#[0-9]+);)')
 
+# The templates use ``xrange`` such that results on Python 2 remain
+# comparable; on Python 3, it's provided as a builtin.
+try:
+    xrange
+except NameError:
+    EXTRA_BUILTINS = {'xrange': range}
+else:
+    EXTRA_BUILTINS = {}
+
 BIGTABLE_ZPT = """\
 <table xmlns="http://www.w3.org/1999/xhtml"
 xmlns:tal="http://xml.zope.org/namespaces/tal">
@@ -36,6 +50,82 @@ xmlns:tal="http://xml.zope.org/namespaces/tal">
 </html>
 """
 
+MACRO_ZPT = """\
+<html xmlns="http://www.w3.org/1999/xhtml"
+xmlns:tal="http://xml.zope.org/namespaces/tal"
+xmlns:metal="http://xml.zope.org/namespaces/metal"
+metal:define-macro="master">
+<head><title metal:define-slot="title">Title</title></head>
+<body>
+<ul metal:define-macro="list">
+<li tal:repeat="item items" metal:define-slot="item">${item}</li>
+</ul>
+<div tal:repeat="i range(20)">
+<span metal:define-macro="label" class="label">${i}</span>
+<ul metal:use-macro="macros['list']">
+<li metal:fill-slot="item"><span metal:use-macro="macros['label']" /></li>
+</ul>
+</div>
+<div metal:define-slot="body" />
+</body>
+</html>
+"""
+
+MACRO_PAGE_ZPT = """\
+<html xmlns="http://www.w3.org/1999/xhtml"
+xmlns:tal="http://xml.zope.org/namespaces/tal"
+xmlns:metal="http://xml.zope.org/namespaces/metal"
+metal:use-macro="master.macros['master']">
+<title metal:fill-slot="title">Page</title>
+<div metal:fill-slot="body">
+<p tal:repeat="i range(20)">${i}</p>
+</div>
+</html>
+"""
+
+# A four-level layout chain: the page uses a section layout which
+# extends a site layout which in turn extends the base layout
+LAYOUT_CHAIN_ZPT = (
+    ("base.pt", """\
+<html xmlns="http://www.w3.org/1999/xhtml"
+xmlns:tal="http://xml.zope.org/namespaces/tal"
+xmlns:metal="http://xml.zope.org/namespaces/metal">
+<head><title metal:define-slot="title">Title</title></head>
+<body>
+<div id="header" metal:define-slot="header">Header</div>
+<div id="content" metal:define-slot="content" />
+<div id="footer" metal:define-slot="footer">Footer</div>
+</body>
+</html>
+"""),
+    ("site.pt", """\
+<html metal:extend-macro="load: base.pt">
+<div id="header" metal:fill-slot="header">
+<h1>Site</h1>
+<ul metal:define-slot="navigation" />
+</div>
+</html>
+"""),
+    ("section.pt", """\
+<html metal:extend-macro="load: site.pt">
+<ul metal:fill-slot="navigation">
+<li tal:repeat="i range(5)">${i}</li>
+</ul>
+<div id="content" metal:fill-slot="content">
+<div metal:define-slot="body" />
+</div>
+</html>
+"""),
+    ("page.pt", """\
+<html metal:use-macro="load: section.pt">
+<title metal:fill-slot="title">Page</title>
+<div metal:fill-slot="body">
+<p tal:repeat="i range(20)">${i}</p>
+</div>
+</html>
+"""),
+    )
+
 I18N_ZPT = """\
 <html xmlns="http://www.w3.org/1999/xhtml"
 xmlns:tal="http://xml.zope.org/namespaces/tal"
@@ -359,7 +449,7 @@ class Benchmarks(unittest.TestCase):
     @staticmethod
     def _chameleon(body, **kwargs):
         from .zpt.template import PageTemplate
-        return PageTemplate(body, **kwargs)
+        return PageTemplate(body, extra_builtins=EXTRA_BUILTINS, **kwargs)
 
     @staticmethod
     def _zope(body):
@@ -464,6 +554,523 @@ class Benchmarks(unittest.TestCase):
         print("                    %0.3fX" % (t_zope / t_chameleon))
 
 
+# Compilation phases in order; the ``program`` phase excludes
+# tokenization and parsing (which the program does on its own) and the
+# ``compile`` phase excludes code generation (which the compiler does
+# on its own).
+COMPILE_PHASES = (
+    "tokenize",      # ``tokenize.scan_xml``
+    "parse",         # ``parser.ElementParser``
+    "program",       # ``zpt.program.MacroProgram``
+    "compile",       # ``compiler.Compiler``
+    "generate",      # ``codegen.TemplateCodeGenerator``
+    "bytecode",      # ``compile()``
+    "write",         # ``loader.ModuleLoader.build``
+    "load",          # ``loader.ModuleLoader.get``
+    )
+
+
+def synthetic_template(count):
+    """Return large template with ``count`` sections of typical
+    markup."""
+
+    section = """\
+  <div class="section" tal:define="title 'Section %(i)d'"
+       tal:condition="python: %(i)d %% 3">
+    <h2 tal:content="title" i18n:translate="">Title</h2>
+    <ul>
+      <li tal:repeat="item items"
+          tal:attributes="class python: repeat.item.odd and 'odd' or None">
+        <a href="${item.url}" title="${item.title}">${item.title}</a>
+      </li>
+    </ul>
+    <p metal:define-macro="paragraph-%(i)d">
+      Lorem ipsum dolor sit amet, ${name}, consectetur adipiscing.
+    </p>
+  </div>
+"""
+
+    return (
+        '<html xmlns:tal="http://xml.zope.org/namespaces/tal"\n'
+        '      xmlns:metal="http://xml.zope.org/namespaces/metal"\n'
+        '      xmlns:i18n="http://xml.zope.org/namespaces/i18n">\n'
+        '<body>\n%s</body>\n</html>\n' % "".join(
+            section % {'i': i} for i in range(count)
+            )
+        )
+
+
+def wide_template(count):
+    """Return template with ``count`` sibling elements."""
+
+    return "<div>\n%s</div>\n" % (
+        '  <p class="item">Item</p>\n' * count)
+
+
+def deep_template(depth):
+    """Return template with elements nested ``depth`` levels deep."""
+
+    return '<div class="level">' * depth + "Item" + "</div>" * depth
+
+
+def attributes_template(count):
+    """Return template with ``count`` form fields and SVG paths (with
+    many attributes each)."""
+
+    row = """\
+  <input type="text" name="field-%(i)d" id="field-%(i)d" class="field"
+         value="" placeholder="Field %(i)d" required disabled=disabled
+         tal:attributes="value python: values[%(i)d]" />
+  <path d="M 10 10 L %(i)d 20" stroke="black" stroke-width="2"
+        fill="none" opacity="0.5" />
+"""
+
+    return (
+        '<form xmlns:tal="http://xml.zope.org/namespaces/tal">\n'
+        '%s</form>\n' % "".join(row % {'i': i} for i in range(count))
+        )
+
+
+def load_corpus(path=None):
+    """Return list of ``(filename, body)`` for the test inputs."""
+
+    if path is None:
+        path = os.path.join(os.path.dirname(__file__), "tests", "inputs")
+
+    corpus = []
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith(".pt"):
+            continue
+
+        f = open(os.path.join(path, filename), "rb")
+        try:
+            body = f.read()
+        finally:
+            f.close()
+
+        corpus.append((filename, read_bytes(body, "utf-8")[0]))
+
+    return corpus
+
+
+def time_phases(body, filename="<string>", loader=None):
+    """Compile template ``body`` phase by phase.
+
+    Returns a dictionary mapping each of the ``COMPILE_PHASES`` to the
+    time spent in seconds. The loader phases are only timed if a
+    module ``loader`` is provided.
+    """
+
+    from . import compiler
+    from . import program as elements
+    from .nodes import Module
+    from .zpt.template import PageTemplate
+
+    template = PageTemplate(None, filename=filename)
+    timings = dict.fromkeys(("tokenize", "parse"), 0.0)
+    tokens = []
+
+    # The phases are interleaved when a template is parsed; the parser
+    # is replaced such that each phase runs to completion in turn and
+    # all phases are timed in the same run.
+    factory = elements.ElementParser
+
+    class ElementParser(factory):
+        def __init__(self, stream, *args):
+            start = time.time()
+            stream = list(stream)
+            timings["tokenize"] += time.time() - start
+            tokens.extend(stream)
+            factory.__init__(self, iter(stream), *args)
+
+        def __iter__(self):
+            start = time.time()
+            items = list(factory.__iter__(self))
+            timings["parse"] += time.time() - start
+            return iter(items)
+
+    elements.ElementParser = ElementParser
+    try:
+        start = time.time()
+        program = template.parse(body)
+        timings["program"] = time.time() - start - \
+                             timings["tokenize"] - timings["parse"]
+    finally:
+        elements.ElementParser = factory
+
+    builtins = template.builtins.copy()
+    builtins.update(template.extra_builtins)
+
+    elapsed = []
+
+    class TemplateCodeGenerator(compiler.TemplateCodeGenerator):
+        def __init__(self, tree, *args):
+            start = time.time()
+            super(TemplateCodeGenerator, self).__init__(tree, *args)
+            elapsed.append(time.time() - start)
+
+    factory = compiler.TemplateCodeGenerator
+    compiler.TemplateCodeGenerator = TemplateCodeGenerator
+    try:
+        start = time.time()
+        source = compiler.Compiler(
+            template.engine, Module("initialize", program),
+            tuple(builtins), strict=template.strict
+            ).code
+        timings["compile"] = time.time() - start - sum(elapsed)
+        timings["generate"] = sum(elapsed)
+    finally:
+        compiler.TemplateCodeGenerator = factory
+
+    start = time.time()
+    compile(source, filename, 'exec')
+    timings["bytecode"] = time.time() - start
+
+    if loader is not None:
+        name = "benchmark_%d_%d.py" % (id(source), len(loader.path))
+        start = time.time()
+        loader.build(source, name)
+        timings["write"] = time.time() - start
+
+        # Remove module such that it's loaded from disk
+        loader.unload(name)
+        start = time.time()
+        loader.get(name)
+        timings["load"] = time.time() - start
+        loader.unload(name)
+
+    timings["elements"] = len([
+        kind for kind, start, end in tokens
+        if kind in ("start_tag", "empty_tag")
+        ])
+
+    return timings
+
+
+def benchmark_compilation(templates, repeat=3, loader=None):
+    """Time compilation phases for a sequence of templates.
+
+    The templates are given as ``(filename, body)`` tuples. For each
+    template and phase, the best time of ``repeat`` runs is used.
+
+    Returns a dictionary with the total time of each phase, the
+    number of templates, bytes and elements compiled, and the
+    templates which failed to compile (as ``skipped``, a list of
+    filename and error message tuples).
+    """
+
+    result = dict((phase, 0.0) for phase in COMPILE_PHASES)
+    result.update(templates=0, bytes=0, elements=0, skipped=[])
+
+    for filename, body in templates:
+        best = {}
+        try:
+            for i in range(repeat):
+                timings = time_phases(body, filename, loader)
+                for phase, value in timings.items():
+                    best[phase] = min(best.get(phase, value), value)
+        except Exception:
+            exc = sys.exc_info()[1]
+            result["skipped"].append((filename, "%s: %s" % (
+                type(exc).__name__, str(exc).split("\n")[0])))
+            continue
+
+        for phase in COMPILE_PHASES:
+            result[phase] += best.get(phase, 0.0)
+
+        result["templates"] += 1
+        result["bytes"] += len(body.encode('utf-8'))
+        result["elements"] += best["elements"]
+
+    return result
+
+
+def format_compilation(result):
+    """Format result of ``benchmark_compilation`` as a table of
+    per-phase throughput."""
+
+    lines = ["%-10s %10s %10s %12s" % (
+        "phase", "time (ms)", "MB/s", "elements/s")]
+
+    total = 0.0
+    for phase in COMPILE_PHASES + ("total", ):
+        if phase == "total":
+            elapsed = total
+        else:
+            elapsed = result[phase]
+            total += elapsed
+
+        if elapsed <= 0:
+            continue
+
+        lines.append("%-10s %10.2f %10.2f %12.0f" % (
+            phase, elapsed * 1000,
+            result["bytes"] / elapsed / 1000000,
+            result["elements"] / elapsed,
+            ))
+
+    lines.append("(%d templates, %d bytes, %d elements)" % (
+        result["templates"], result["bytes"], result["elements"]))
+
+    skipped = result.get("skipped")
+    if skipped:
+        lines.append("(%d templates skipped)" % len(skipped))
+        for filename, error in skipped:
+            lines.append("  %s: %s" % (filename, error))
+
+    return "\n".join(lines)
+
+
+def start_compilation(repeat=3):
+    import shutil
+    import tempfile
+    from .loader import ModuleLoader
+
+    path = tempfile.mkdtemp()
+    try:
+        loader = ModuleLoader(path)
+
+        workloads = [("corpus", load_corpus())] + [
+            ("synthetic (%d)" % count,
+             [("synthetic.pt", synthetic_template(count))])
+            for count in (10, 100, 300)
+            ]
+
+        for title, templates in workloads:
+            print("==========================\n "
+                  "COMPILATION PHASES: %s\n"
+                  "==========================" % title)
+            result = benchmark_compilation(templates, repeat, loader)
+            print(format_compilation(result))
+    finally:
+        shutil.rmtree(path)
+
+
+PARSE_MODES = (
+    "identify",      # tokens matched by ``tokenize.re_xml_spe`` which
+                     # the parser identifies (using ``parser.identify``)
+    "scan",          # ``tokenize.scan_xml`` tokens with their kind
+    )
+
+
+def time_parsing(body, mode, repeat=3):
+    """Time tokenization and parsing of ``body`` into elements using
+    one of the ``PARSE_MODES``.
+
+    Returns a tuple of the best time in seconds of ``repeat`` runs to
+    tokenize (including the kind of each token) and to tokenize and
+    parse. Garbage collection is disabled while timing (like
+    ``timeit``).
+    """
+
+    import gc
+    from .parser import ElementParser
+    from .parser import identify
+    from .tokenize import Token
+    from .tokenize import re_xml_spe
+    from .tokenize import scan_xml
+    from .zpt.program import MacroProgram
+
+    namespaces = MacroProgram.DEFAULT_NAMESPACES
+
+    def tokens():
+        for match in re_xml_spe.finditer(body):
+            yield Token(match.group(), match.start(), body)
+
+    if mode == "identify":
+        def tokenize():
+            for token in tokens():
+                identify(token)
+
+        def parse():
+            list(ElementParser(tokens(), namespaces))
+    else:
+        def tokenize():
+            for kind, start, end in scan_xml(body):
+                Token(body[start:end], start, body)
+
+        def parse():
+            list(ElementParser(scan_xml(body), namespaces, body))
+
+    result = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for function in (tokenize, parse):
+            times = []
+            for i in range(repeat):
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+            result.append(min(times))
+    finally:
+        if enabled:
+            gc.enable()
+
+    return tuple(result)
+
+
+def start_parsing(repeat=5):
+    corpus = [
+        body for filename, body in load_corpus()
+        if "error" not in filename
+        ]
+
+    workloads = [
+        ("corpus", corpus),
+        ("synthetic (1000)", [synthetic_template(1000)]),
+        ("wide (10000)", [wide_template(10000)]),
+        ("deep (1000)", [deep_template(1000)]),
+        ("attributes (1000)", [attributes_template(1000)]),
+        ]
+
+    print("==========================\n "
+          "PARSING\n"
+          "==========================")
+    print("%-18s %-10s %14s %8s %10s %10s %8s" % (
+        "workload", "mode", "tokenize (ms)", "speedup",
+        "total (ms)", "MB/s", "speedup"))
+
+    for title, bodies in workloads:
+        size = sum(len(body.encode('utf-8')) for body in bodies)
+        baseline = None
+        for mode in PARSE_MODES:
+            elapsed = [0.0, 0.0]
+            for body in bodies:
+                try:
+                    timings = time_parsing(body, mode, repeat)
+                except Exception:
+                    continue
+                elapsed[0] += timings[0]
+                elapsed[1] += timings[1]
+
+            if baseline is None:
+                baseline = elapsed
+
+            print("%-18s %-10s %14.2f %7.2fx %10.2f %10.2f %7.2fx" % (
+                title, mode, elapsed[0] * 1000, baseline[0] / elapsed[0],
+                elapsed[1] * 1000, size / elapsed[1] / 1000000,
+                baseline[1] / elapsed[1]))
+
+
+PRELOAD_MODES = (
+    "default",       # templates are compiled in the master process
+    "preload",       # ``chameleon.preload``
+    "freeze",        # ``chameleon.preload`` with ``freeze=True``
+    )
+
+
+def unique_memory():
+    """Return the unique set size (memory not shared with other
+    processes) of the current process in bytes, or ``None`` if not
+    available (requires Linux)."""
+
+    try:
+        f = open("/proc/self/smaps")
+    except IOError:
+        return None
+
+    total = 0
+    try:
+        for line in f:
+            if line.startswith("Private_"):
+                total += int(line.split()[1])
+    finally:
+        f.close()
+
+    return total * 1024
+
+
+def forked(function, *args):
+    """Call function in a forked process and return its (numeric)
+    result."""
+
+    from .utils import encode_string
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            os.write(write, encode_string(repr(function(*args))))
+        finally:
+            os._exit(0)
+
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    os.close(read)
+    os.waitpid(pid, 0)
+    return float(encode_string("").join(chunks))
+
+
+def preload_master(path, mode, workers, requests):
+    """Load the templates in ``path`` as a prefork server's master
+    process would (according to ``mode``) and return the mean unique
+    memory of its workers after ``requests`` requests each."""
+
+    from .loader import preload
+    from .zpt.loader import TemplateLoader
+
+    loader = TemplateLoader(path)
+    names = sorted(os.listdir(path))
+
+    if mode == "default":
+        for name in names:
+            loader[name].cook_check()
+    else:
+        preload(loader, "*.pt", freeze=mode == "freeze")
+
+    items = [{"url": "/item-%d" % i, "title": "Item %d" % i}
+             for i in range(10)]
+
+    def worker():
+        for i in range(requests):
+            loader[names[i % len(names)]](items=items, name="World")
+        return unique_memory()
+
+    results = [forked(worker) for i in range(workers)]
+    return sum(results) / len(results)
+
+
+def start_preload(templates=50, workers=2, requests=200):
+    import gc
+    import shutil
+    import tempfile
+
+    if not hasattr(os, "fork") or unique_memory() is None:
+        print("Forked worker memory can be measured on Linux only.")
+        return
+
+    path = tempfile.mkdtemp()
+    try:
+        for i in range(templates):
+            f = open(os.path.join(path, "page-%03d.pt" % i), "w")
+            try:
+                f.write(synthetic_template(1 + i % 10))
+            finally:
+                f.close()
+
+        print("==========================\n "
+              "FORKED WORKER MEMORY\n"
+              "==========================")
+        print("(%d templates, %d workers, %d requests per worker)" % (
+            templates, workers, requests))
+        if not hasattr(gc, "freeze"):
+            print("(gc.freeze is not available; requires Python 3.7)")
+        print("%-10s %16s" % ("mode", "unique (KB)"))
+        for mode in PRELOAD_MODES:
+            size = forked(preload_master, path, mode, workers, requests)
+            print("%-10s %16.1f" % (mode, size / 1024))
+    finally:
+        shutil.rmtree(path)
+
+
 def start():
     result = unittest.TestResult()
     test = unittest.makeSuite(Benchmarks)
@@ -476,3 +1083,311 @@ def start():
     for failure in result.failures:
         print("Failure in %s...\n" % failure[0])
         print(failure[1])
+
+    start_compilation()
+
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def simple_translate(msgid, domain=None, mapping=None, context=None,
+                     target_language=None, default=None):
+    return msgid.upper()
+
+
+def bigtable_workload():
+    from .zpt.template import PageTemplate
+    template = PageTemplate(BIGTABLE_ZPT)
+    options = {'table': Benchmarks.table}
+    return lambda: template(options=options)
+
+
+def many_strings_workload():
+    from .zpt.template import PageTemplate
+    return PageTemplate(MANY_STRINGS_ZPT, extra_builtins=EXTRA_BUILTINS)
+
+
+def hello_world_workload():
+    from .zpt.template import PageTemplate
+    return PageTemplate(HELLO_WORLD_ZPT)
+
+
+def i18n_workload():
+    from .zpt.template import PageTemplate
+    template = PageTemplate(I18N_ZPT, extra_builtins=EXTRA_BUILTINS)
+    return lambda: template(translate=simple_translate)
+
+
+def macro_workload():
+    from .zpt.template import PageTemplate
+    master = PageTemplate(MACRO_ZPT)
+    template = PageTemplate(MACRO_PAGE_ZPT)
+    items = list(range(10))
+    return lambda: template(master=master, items=items)
+
+
+def layout_chain_workload(**config):
+    import shutil
+    import tempfile
+    from .zpt.template import PageTemplateFile
+    path = tempfile.mkdtemp()
+    try:
+        for filename, body in LAYOUT_CHAIN_ZPT:
+            f = open(os.path.join(path, filename), "w")
+            try:
+                f.write(body)
+            finally:
+                f.close()
+
+        template = PageTemplateFile(os.path.join(path, "page.pt"), **config)
+        template()
+    finally:
+        shutil.rmtree(path)
+
+    return template
+
+
+def inline_layout_chain_workload():
+    return layout_chain_workload(inline_macros=100)
+
+
+def compile_workload():
+    from .zpt.template import PageTemplate
+    body = synthetic_template(10)
+    template = PageTemplate(body)
+    return lambda: template.cook(body)
+
+
+# Each workload is a function which returns the callable to benchmark
+WORKLOADS = (
+    ("bigtable", bigtable_workload),
+    ("many-strings", many_strings_workload),
+    ("hello-world", hello_world_workload),
+    ("i18n", i18n_workload),
+    ("macro-heavy", macro_workload),
+    ("layout-chain", layout_chain_workload),
+    ("layout-chain-inline", inline_layout_chain_workload),
+    ("compile", compile_workload),
+    )
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stdev(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / len(values)
+    return math.sqrt(
+        sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+        )
+
+
+def measure(function, runs=10, warmup=2, duration=0.01):
+    """Run ``function`` repeatedly and return timing statistics (per
+    call).
+
+    Peak memory usage of a single call is included when the
+    ``tracemalloc`` module is available (Python 3.4 and up).
+    """
+
+    for i in range(warmup):
+        function()
+
+    # Calibrate the number of calls per run such that each run takes
+    # at least ``duration`` seconds (to limit the timer resolution)
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number):
+            function()
+        if time.time() - start >= duration:
+            break
+        number *= 2
+
+    times = []
+    for i in range(runs):
+        start = time.time()
+        for j in range(number):
+            function()
+        times.append((time.time() - start) / number)
+
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    else:
+        peak = None
+
+    mean = sum(times) / len(times)
+    return {
+        "runs": runs,
+        "number": number,
+        "mean": mean,
+        "median": median(times),
+        "stdev": stdev(times),
+        "min": min(times),
+        "ops": 1.0 / mean if mean else None,
+        "peak_memory": peak,
+        }
+
+
+def run(names=None, runs=10, warmup=2, out=None):
+    """Run workloads (all by default) and return results.
+
+    If ``out`` is provided, each workload's result is written to it
+    as it completes.
+    """
+
+    results = {}
+    for name, factory in WORKLOADS:
+        if names and name not in names:
+            continue
+
+        result = results[name] = measure(factory(), runs, warmup)
+        if out is not None:
+            out.write("%-20s %s\n" % (name, format_result(result)))
+
+    return {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "time": time.time(),
+        "results": results,
+        }
+
+
+def format_result(result):
+    peak = result["peak_memory"]
+    return "mean %9.3f ms  median %9.3f ms  stdev %7.3f ms  " \
+           "%9.1f ops/s  peak %s" % (
+               result["mean"] * 1000, result["median"] * 1000,
+               result["stdev"] * 1000, result["ops"] or 0,
+               "%.1f KB" % (peak / 1024.0) if peak is not None else "n/a",
+               )
+
+
+def compare(baseline, current, threshold=0.05):
+    """Compare two sets of results.
+
+    Returns a list of ``(name, baseline, current, change, regression)``
+    tuples where ``change`` is the relative change in mean time. A
+    workload regresses when its mean time increases by more than the
+    ``threshold`` fraction.
+    """
+
+    rows = []
+    for name in sorted(current["results"]):
+        if name not in baseline["results"]:
+            continue
+
+        before = baseline["results"][name]["mean"]
+        after = current["results"][name]["mean"]
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change, change > threshold))
+
+    return rows
+
+
+def format_comparison(rows):
+    lines = ["%-20s %12s %12s %9s" % (
+        "workload", "before (ms)", "after (ms)", "change")]
+    for name, before, after, change, regression in rows:
+        lines.append("%-20s %12.3f %12.3f %+8.1f%%%s" % (
+            name, before * 1000, after * 1000, change * 100,
+            "  REGRESSION" if regression else ""))
+    return "\n".join(lines)
+
+
+def read_results(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] [workload ...]",
+        description=(
+            "Run Chameleon benchmarks and optionally compare the results "
+            "to a baseline. Available workloads: %s." % ", ".join(
+                name for name, factory in WORKLOADS)))
+    parser.add_option("-n", "--runs", type="int", default=10,
+                      help="Number of timed runs per workload.")
+    parser.add_option("-w", "--warmup", type="int", default=2,
+                      help="Number of warmup runs per workload.")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="Write results as JSON to FILE.")
+    parser.add_option("-c", "--compare", metavar="FILE",
+                      help="Compare results to baseline JSON FILE.")
+    parser.add_option("-r", "--results", metavar="FILE",
+                      help="Compare results JSON FILE to the baseline "
+                      "instead of running the benchmarks.")
+    parser.add_option("-t", "--threshold", type="float", default=0.05,
+                      help="Relative increase in mean time which is "
+                      "reported as a regression (default: 0.05).")
+    parser.add_option("--phases", action="store_true",
+                      help="Time each compilation phase instead.")
+    parser.add_option("--parse", action="store_true",
+                      help="Time tokenization and parsing instead.")
+    parser.add_option("--preload", action="store_true",
+                      help="Measure the unique memory of forked workers "
+                      "with and without preloading instead.")
+    options, args = parser.parse_args(args)
+
+    if options.phases:
+        start_compilation()
+        return 0
+
+    if options.parse:
+        start_parsing()
+        return 0
+
+    if options.preload:
+        start_preload()
+        return 0
+
+    if options.results:
+        if not options.compare:
+            parser.error("--results requires --compare")
+        if args:
+            parser.error("no workloads can be given with --results")
+        current = read_results(options.results)
+    else:
+        names = set(args)
+        unknown = names - set(name for name, factory in WORKLOADS)
+        if unknown:
+            parser.error("unknown workload: %s" % ", ".join(sorted(unknown)))
+        current = run(names, options.runs, options.warmup, sys.stdout)
+
+    if options.output:
+        f = open(options.output, "w")
+        try:
+            json.dump(current, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare:
+        rows = compare(
+            read_results(options.compare), current, options.threshold)
+        print(format_comparison(rows))
+        if any(row[4] for row in rows):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
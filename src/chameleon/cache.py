@@ -0,0 +1,88 @@
+"""Manage the template cache directory (see ``CHAMELEON_CACHE``).
+
+To remove the least recently used modules from the cache directory::
+
+  $ python -m chameleon.cache prune --max-entries 10000 /path/to/cache
+
+To write the modules in the cache directory to a bundle file (see
+``CHAMELEON_BUNDLE``)::
+
+  $ python -m chameleon.cache bundle -o templates.bundle /path/to/cache
+
+"""
+
+import optparse
+import os
+import sys
+
+from .config import CACHE_DIRECTORY
+from .loader import ModuleLoader
+
+
+COMMANDS = ("prune", "stats", "bundle")
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] command [path]",
+        description=(
+            "Manage a template cache directory (the default is the "
+            "CHAMELEON_CACHE setting). Available commands: %s." %
+            ", ".join(COMMANDS)))
+    parser.add_option("-n", "--max-entries", type="int",
+                      help="Maximum number of modules to keep.")
+    parser.add_option("-b", "--max-bytes", type="int",
+                      help="Maximum total size in bytes of the modules "
+                      "to keep.")
+    parser.add_option("-a", "--max-age", type="float", metavar="DAYS",
+                      help="Remove modules which have not been used for "
+                      "the given number of days.")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="Bundle file to write.")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="List the removed modules.")
+    options, args = parser.parse_args(args)
+
+    if not args or args[0] not in COMMANDS:
+        parser.error("a command is required: %s" % ", ".join(COMMANDS))
+
+    if len(args) > 2:
+        parser.error("too many arguments")
+
+    path = args[1] if len(args) > 1 else CACHE_DIRECTORY
+    if path is None:
+        parser.error("no cache directory given")
+    if not os.path.isdir(path):
+        parser.error("not a directory: %s" % path)
+
+    loader = ModuleLoader(path)
+
+    if args[0] == "bundle":
+        if options.output is None:
+            parser.error("an output file is required (-o)")
+
+        count = loader.bundle(options.output)
+        print("Wrote %d modules to %s." % (count, options.output))
+        return 0
+
+    if args[0] == "prune":
+        max_age = options.max_age
+        if max_age is not None:
+            max_age *= 86400
+
+        removed = loader.prune(options.max_entries, options.max_bytes, max_age)
+        if options.verbose:
+            for filename in removed:
+                print(filename)
+
+        print("Removed %d modules." % len(removed))
+
+    stats = loader.stats()
+    print("%d modules (%d bytes) in %s." % (
+        stats['entries'], stats['bytes'], path))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,8 @@ try:
 except ImportError:
     from chameleon import ast25 as ast
 
+import sys
+import bisect
 import inspect
 import textwrap
 import types
@@ -110,10 +112,12 @@ class TemplateCodeGenerator(ASTCodeGenerator):
 
     names = ()
 
-    def __init__(self, tree):
+    def __init__(self, tree, location_table=False):
+        self.location_table = location_table
         self.imports = {}
         self.defines = {}
         self.markers = {}
+        self.locations = []
 
         # Generate code
         super(TemplateCodeGenerator, self).__init__(tree)
@@ -165,8 +169,37 @@ class TemplateCodeGenerator(ASTCodeGenerator):
         self.flush()
 
         # Stich together lines
+        offset = len(self.lines) + len(defines)
         self.lines += defines + body
 
+        table = self.location_table and self.locations and \
+                self.make_location_table(offset)
+        if table:
+            self.lines.append("__locations = %r" % (table, ))
+
+    def make_location_table(self, offset):
+        """Return table of template source locations.
+
+        The table is a tuple ``(name, entries)`` where ``name`` is the
+        name of the top-level function. Each entry is a tuple
+        ``(lineno, filename, line, column, text)``; the first item is
+        the generated line number relative to that of the function
+        definition. This makes the table independent of any header
+        prepended to the code.
+        """
+
+        for index, line in enumerate(self.lines):
+            if line.startswith('def '):
+                break
+        else:
+            return
+
+        name = line[4:line.index('(')]
+        return name, tuple(
+            (offset + i - index, ) + location
+            for i, location in self.locations
+            )
+
     def define(self, name, node):
         assert node is not None
         value = self.defines.get(name)
@@ -215,6 +248,9 @@ class TemplateCodeGenerator(ASTCodeGenerator):
             self._new_line()
             self._write("%s#%s" % (node.space, line))
 
+        if node.location is not None:
+            self.locations.append((len(self.lines), node.location))
+
     def visit_Builtin(self, node):
         name = load(node.id)
         self.visit(name)
@@ -231,3 +267,68 @@ class TemplateCodeGenerator(ASTCodeGenerator):
 
         node = self.define(name, node.value)
         self.visit(node)
+
+
+def compile_mapped(source, locations):
+    """Compile module source such that code objects refer to the
+    template source.
+
+    The filename and line numbers of the code objects are taken from
+    the location table (see ``TemplateCodeGenerator``); each statement
+    and expression is given the template line of the nearest location
+    preceding it in the generated source.
+    """
+
+    name, entries = locations
+    tree = compile(source, "<template>", 'exec', ast.PyCF_ONLY_AST)
+
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            break
+    else:
+        raise ValueError("Function not found: %s." % name)
+
+    lines = [node.lineno + entry[0] for entry in entries]
+    filename = entries[0][1] if entries else "<string>"
+
+    # Before Python 3.6, line number increments must be positive
+    monotonic = sys.version_info < (3, 6)
+
+    def remap(node, minimum, start, default):
+        lineno = getattr(node, 'lineno', None)
+        if lineno is not None:
+            index = bisect.bisect_right(lines, lineno) - 1
+            lineno = entries[index][2] if index >= start else default
+
+            # A function is given the line of the first location in
+            # its body; locations preceding it are not used.
+            if isinstance(node, ast.FunctionDef):
+                start = bisect.bisect_left(lines, node.lineno)
+                if start < len(lines):
+                    lineno = entries[start][2]
+
+            if monotonic:
+                lineno = max(lineno, minimum)
+
+            node.lineno = lineno
+            if getattr(node, 'end_lineno', None) is not None:
+                node.end_lineno = lineno
+                node.end_col_offset = max(
+                    node.end_col_offset, node.col_offset
+                    )
+
+            if isinstance(node, ast.FunctionDef):
+                for child in ast.iter_child_nodes(node):
+                    remap(child, lineno, start, lineno)
+                return lineno
+
+            minimum = lineno
+
+        for child in ast.iter_child_nodes(node):
+            minimum = remap(child, minimum, start, default)
+
+        return minimum
+
+    remap(tree, 1, 0, 1)
+
+    return compile(tree, filename, 'exec')
@@ -35,6 +35,8 @@ from .nodes import Substitution
 from .nodes import Assignment
 from .nodes import Module
 from .nodes import Context
+from .nodes import Element
+from .nodes import DefineSlot
 
 from .tokenize import Token
 from .config import DEBUG_MODE
@@ -54,6 +56,7 @@ from .utils import ast
 from .utils import safe_native
 from .utils import builtins
 from .utils import decode_htmlentities
+from .utils import limit_string
 
 
 if version >= (3, 0, 0):
@@ -93,6 +96,15 @@ def mangle(string):
     return RE_MANGLE.sub('_', str(string)).replace('\n', '').replace('-', '_')
 
 
+def get_function_name(macro):
+    """Return name of render function for ``macro`` (``None`` for
+    the template itself)."""
+
+    if macro is None:
+        return "render"
+    return "render_%s" % mangle(macro)
+
+
 def load_econtext(name):
     return template("getitem(KEY)", KEY=ast.Str(s=name), mode="eval")
 
@@ -107,6 +119,27 @@ def store_rcontext(name):
     return subscript(name, load("rcontext"), ast.Store())
 
 
+def get_location(node):
+    """Return template source location of expression or token.
+
+    The location is a ``(filename, line, column, text)`` tuple, or
+    ``None`` if the location is not known.
+    """
+
+    while node is not None and not isinstance(node, Token):
+        if isinstance(node, string_type):
+            return
+
+        node = getattr(node, "value", None)
+
+    if node is None:
+        return
+
+    line, column = node.location
+    text = limit_string(" ".join(node.split()), 40)
+    return node.filename, line, column, unicode_string(text)
+
+
 def set_error(token, exception):
     try:
         line, column = token.location
@@ -117,11 +150,19 @@ def set_error(token, exception):
 
     string = safe_native(token)
 
+    # The line is relative to that of the compiled module (see
+    # ``BaseTemplate._relocate``)
+    if line:
+        line = ast.BinOp(
+            left=ast.Num(n=line), op=ast.Add(), right=load("__line_offset"))
+    else:
+        line = ast.Num(n=line)
+
     return template(
         "rcontext.setdefault('__error__', [])."
         "append((string, line, col, src, exc))",
         string=ast.Str(s=string),
-        line=ast.Num(n=line),
+        line=line,
         col=ast.Num(n=column),
         src=ast.Str(s=filename),
         sys=Symbol(sys),
@@ -346,7 +387,7 @@ class Interpolator(object):
                 if string:
                     try:
                         compiler = engine.parse(string)
-                        body += compiler.assign_text(target)
+                        stmts = compiler.assign_text(target)
                     except ExpressionError:
                         matched = matched[m.start():m.end() - 1]
                         m = self.regex.search(matched)
@@ -354,6 +395,15 @@ class Interpolator(object):
                             raise
 
                         continue
+
+                    # Record the location of each individual expression
+                    location = get_location(text[:len(m.group())])
+                    if location is not None:
+                        body.append(
+                            Comment(" " + location[3], location=location)
+                            )
+
+                    body += stmts
                 else:
                     s = m.group()
                     assign = ast.Assign(targets=[target], value=ast.Str(s=s))
@@ -470,6 +520,10 @@ class ExpressionEngine(object):
 
     supported_char_escape_set = set(('&', '<', '>'))
 
+    # Set of static dependencies of the compiled expressions (see
+    # ``add_dependency``); set by the compiler
+    dependencies = None
+
     def __init__(self, parser, char_escape=(),
                  default=None, default_marker=None):
         self._parser = parser
@@ -485,6 +539,18 @@ class ExpressionEngine(object):
         compiler = self.parse(string)
         return compiler(string, target)
 
+    def add_dependency(self, kind, name):
+        """Record static dependency of an expression.
+
+        The kind is ``"import"`` for a literal ``import:`` expression;
+        otherwise, it's the name of a builtin function which is called
+        with the literal string ``name`` (e.g. to load a template
+        using a literal path).
+        """
+
+        if self.dependencies is not None:
+            self.dependencies.add((kind, name))
+
     def parse(self, string):
         expression = self._parser(string)
         compiler = self.get_compiler(expression, string)
@@ -729,6 +795,12 @@ class ExpressionTransform(object):
         self.cache = cache
         self.strict = strict
         self.visitor = visitor
+        self.dependencies = set()
+
+    def create_engine(self, **kwargs):
+        engine = self.engine_factory(**kwargs)
+        engine.dependencies = self.dependencies
+        return engine
 
     def __call__(self, expression, target):
         if isinstance(target, string_type):
@@ -780,13 +852,16 @@ class ExpressionTransform(object):
 
             # Add comment
             target_id = getattr(target, "id", target)
-            comment = Comment(" %r -> %s" % (expression, target_id))
+            comment = Comment(
+                " %r -> %s" % (expression, target_id),
+                location=get_location(expression),
+                )
             stmts.insert(0, comment)
 
         return stmts
 
     def visit_Value(self, node, target):
-        engine = self.engine_factory()
+        engine = self.create_engine()
         compiler = engine.parse(node.value)
         return compiler.assign_value(target)
 
@@ -798,7 +873,7 @@ class ExpressionTransform(object):
         return [ast.Assign(targets=[target], value=value)]
 
     def visit_Substitution(self, node, target):
-        engine = self.engine_factory(
+        engine = self.create_engine(
             char_escape=node.char_escape,
             default=node.default,
             )
@@ -824,19 +899,19 @@ class ExpressionTransform(object):
                template("TARGET = __expression == __value", TARGET=target)
 
     def visit_Boolean(self, node, target):
-        engine = self.engine_factory()
+        engine = self.create_engine()
         compiler = engine.parse(node.value)
         return compiler.assign_bool(target, node.s)
 
     def visit_Interpolation(self, node, target):
         expr = node.value
         if isinstance(expr, Substitution):
-            engine = self.engine_factory(
+            engine = self.create_engine(
                 char_escape=expr.char_escape,
                 default=expr.default,
                 )
         elif isinstance(expr, Value):
-            engine = self.engine_factory()
+            engine = self.create_engine()
         else:
             raise RuntimeError("Bad value: %r." % node.value)
 
@@ -887,14 +962,19 @@ class Compiler(object):
 
     global_builtins = set(builtins.__dict__)
 
-    def __init__(self, engine_factory, node, builtins={}, strict=True):
+    def __init__(self, engine_factory, node, builtins={}, strict=True,
+                 inline_macros=0, macros=None, location_table=False):
         self._scopes = [set()]
         self._expression_cache = {}
+        self._inline_macros = inline_macros
+        self._selected_macros = macros
+        self._internal_macros = {}
         self._translations = []
         self._builtins = builtins
         self._aliases = [{}]
         self._macros = []
         self._current_slot = []
+        self.dependencies = []
 
         internals = COMPILER_INTERNALS_OR_DISALLOWED | \
                     set(self.defaults)
@@ -924,7 +1004,7 @@ class Compiler(object):
             module = ast.Module([])
             module.body += self.visit(node)
             ast.fix_missing_locations(module)
-            generator = TemplateCodeGenerator(module)
+            generator = TemplateCodeGenerator(module, location_table)
         finally:
             if backup is not None:
                 node_annotations.clear()
@@ -964,6 +1044,7 @@ class Compiler(object):
         body += template("import functools")
         body += template("from itertools import chain as __chain")
         body += template("__marker = object()")
+        body += template("__line_offset = 0")
         body += template(
             r"g_re_amp = re.compile(r'&(?!([A-Za-z]+|#[0-9]+);)')"
         )
@@ -978,6 +1059,23 @@ class Compiler(object):
         # Visit module content
         program = self.visit(node.program)
 
+        # Record static dependencies in the module (the program is not
+        # compiled if the module is found in the cache)
+        self.dependencies = sorted(
+            (kind, name) for kind, name in self._engine.dependencies
+            if kind == "import" or kind in self._builtins
+            )
+        if self.dependencies:
+            body += [ast.Assign(
+                targets=[store("__dependencies")],
+                value=ast.Tuple(elts=[
+                    ast.Tuple(
+                        elts=[ast.Str(s=kind), ast.Str(s=name)],
+                        ctx=ast.Load())
+                    for kind, name in self.dependencies
+                    ], ctx=ast.Load()),
+                )]
+
         body += [ast.FunctionDef(
             name=node.name, args=ast.arguments(
                 args=[param(b) for b in self._builtins],
@@ -994,7 +1092,18 @@ class Compiler(object):
         # Visit defined macros
         macros = getattr(node, "macros", ())
         names = []
+
+        if self._inline_macros:
+            for macro in macros:
+                if macro.name is not None and \
+                       self._is_inlineable(macro, self._inline_macros):
+                    self._internal_macros[macro.name] = macro
+
         for macro in macros:
+            if self._selected_macros is not None and \
+                   macro.name not in self._selected_macros:
+                continue
+
             stmts = self.visit(macro)
             function = stmts[-1]
             names.append(function.name)
@@ -1034,6 +1143,10 @@ class Compiler(object):
         # Internal set of defined slots
         self._slots = set()
 
+        # Cached expressions are local to the function (an inlined
+        # macro body is visited again in another function)
+        self._expression_cache.clear()
+
         # Visit macro body
         nodes = itertools.chain(*tuple(map(self.visit, node.body)))
 
@@ -1047,8 +1160,7 @@ class Compiler(object):
         # Append visited nodes
         body += nodes
 
-        function_name = "render" if node.name is None else \
-                        "render_%s" % mangle(node.name)
+        function_name = get_function_name(node.name)
 
         function = ast.FunctionDef(
             name=function_name, args=ast.arguments(
@@ -1291,10 +1403,17 @@ class Compiler(object):
         except AttributeError:
             line, column = 0, 0
 
+        location = get_location(node.prefix)
+        if location is not None:
+            location = location[:3] + (
+                unicode_string(node.prefix + node.name), )
+
         yield Comment(
             " %s%s ... (%d:%d)\n"
             " --------------------------------------------------------" % (
-                node.prefix, node.name, line, column))
+                node.prefix, node.name, line, column),
+            location=location,
+            )
 
         if node.attributes:
             for stmt in emit_node(ast.Str(s=node.prefix + node.name)):
@@ -1423,10 +1542,20 @@ class Compiler(object):
         return body
 
     def visit_UseInternalMacro(self, node):
-        if node.name is None:
-            render = "render"
-        else:
-            render = "render_%s" % mangle(node.name)
+        macro = self._internal_macros.get(node.name)
+        if macro is not None:
+            # Render the macro body directly instead of calling the
+            # macro function with a copy of the context.
+            return list(itertools.chain(*tuple(map(self.visit, macro.body))))
+
+        render = get_function_name(node.name)
+
+        # The macro is compiled separately and bound to the template
+        if self._selected_macros is not None and \
+               node.name not in self._selected_macros:
+            render = ast.Attribute(
+                value=load("__template"), attr="_" + render, ctx=ast.Load()
+                )
 
         return template(
             "f(__stream, econtext.copy(), rcontext, __i18n_domain)",
@@ -1452,6 +1581,17 @@ class Compiler(object):
             ast.If(test=test, body=body or [ast.Pass()], orelse=orelse)
             ]
 
+    def _is_inlineable(self, macro, limit):
+        elements = 0
+        for node in macro.extract(lambda node: True):
+            # Slots are resolved when entering the macro function
+            if isinstance(node, DefineSlot):
+                return False
+            if isinstance(node, Element):
+                elements += 1
+
+        return elements <= limit
+
     def visit_Name(self, node):
         """Translation name."""
 
@@ -21,6 +21,11 @@ EAGER_PARSING = EAGER_PARSING.lower() in TRUE
 DEBUG_MODE = os.environ.pop('CHAMELEON_DEBUG', 'false')
 DEBUG_MODE = DEBUG_MODE.lower() in TRUE
 
+# In production mode, a compiled template keeps only its render
+# functions; the template body and parse tree are released.
+PRODUCTION_MODE = os.environ.pop('CHAMELEON_PRODUCTION', 'false')
+PRODUCTION_MODE = PRODUCTION_MODE.lower() in TRUE
+
 # If a cache directory is specified, template source code will be
 # persisted on disk and reloaded between sessions
 path = os.environ.pop('CHAMELEON_CACHE', None)
@@ -34,6 +39,34 @@ if path is not None:
 else:
     CACHE_DIRECTORY = None
 
+# The cache directory is pruned when it exceeds the maximum number of
+# modules and/or total size in bytes (no limit if not set)
+CACHE_MAX_ENTRIES = os.environ.pop('CHAMELEON_CACHE_MAX_ENTRIES', None)
+if CACHE_MAX_ENTRIES is not None:
+    CACHE_MAX_ENTRIES = int(CACHE_MAX_ENTRIES)
+
+CACHE_MAX_BYTES = os.environ.pop('CHAMELEON_CACHE_MAX_BYTES', None)
+if CACHE_MAX_BYTES is not None:
+    CACHE_MAX_BYTES = int(CACHE_MAX_BYTES)
+
+# If a bundle file is specified, compiled templates are loaded from
+# the bundle (see ``python -m chameleon.cache bundle``)
+path = os.environ.pop('CHAMELEON_BUNDLE', None)
+if path is not None:
+    BUNDLE_FILE = os.path.abspath(path)
+    if not os.path.exists(BUNDLE_FILE):
+        raise ValueError(
+            "Bundle file does not exist: %s." % BUNDLE_FILE
+            )
+    log.info("template bundle: %s." % BUNDLE_FILE)
+else:
+    BUNDLE_FILE = None
+
+# When profiling is enabled, templates are compiled with a table of
+# template source locations (see ``chameleon.profiler``).
+PROFILE_MODE = os.environ.pop('CHAMELEON_PROFILE', 'false')
+PROFILE_MODE = PROFILE_MODE.lower() in TRUE
+
 # When auto-reload is enabled, templates are reloaded on file change.
 AUTO_RELOAD = os.environ.pop('CHAMELEON_RELOAD', 'false')
 AUTO_RELOAD = AUTO_RELOAD.lower() in TRUE
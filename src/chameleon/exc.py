@@ -124,6 +124,11 @@ class TemplateError(Exception):
     >>> loads(dumps(TemplateError(message, token)))
     TemplateError('message', 'token')
 
+    The pickled token does not refer to the template source:
+
+    >>> isinstance(loads(dumps(TemplateError(message, token))).token, Token)
+    False
+
     """
 
     def __init__(self, msg, token):
@@ -141,7 +146,16 @@ class TemplateError(Exception):
         return inst
 
     def __reduce__(self):
-        return reconstruct_exc, (type(self), self.__dict__)
+        # The token refers to the entire template source (e.g. when an
+        # exception is pickled into a compiled template); keep just
+        # its location
+        state = self.__dict__.copy()
+        token = state.get('token')
+        if isinstance(token, Token):
+            state['location'] = token.location
+            state['token'] = str(token)
+
+        return reconstruct_exc, (type(self), state)
 
     def __str__(self):
         text = "%s\n\n" % self.msg
@@ -154,10 +168,13 @@ class TemplateError(Exception):
         try:
             line, column = self.token.location
         except AttributeError:
-            pass
+            location = self.__dict__.get('location')
         else:
+            location = line, column
+
+        if location is not None:
             text += "\n"
-            text += " - Location:   (line %d: col %d)" % (line, column)
+            text += " - Location:   (line %d: col %d)" % location
 
         return text
 
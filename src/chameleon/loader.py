@@ -1,32 +1,314 @@
+import fnmatch
 import functools
-import imp
+import gc
+import hashlib
 import logging
+import marshal
+import mmap
 import os
-import py_compile
+import platform
+import struct
 import shutil
+import stat
 import sys
 import tempfile
+import threading
+import types
 import warnings
+import weakref
 import pkg_resources
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from importlib.util import MAGIC_NUMBER as bytecode_magic
+except ImportError:
+    import imp
+    bytecode_magic = imp.get_magic()
+
+from time import time
+
 log = logging.getLogger('chameleon.loader')
 
+from .config import AUTO_RELOAD
+from .config import DEBUG_MODE
+from .utils import byte_string
 from .utils import string_type
 from .utils import encode_string
+from .utils import native_string
+from .utils import hooks
+from .utils import notify
 
 
 def cache(func):
     def load(self, *args, **kwargs):
-        template = self.registry.get(args)
-        if template is None:
-            self.registry[args] = template = func(self, *args, **kwargs)
+        registry = self.registry
+
+        # The lock is held while the template is created such that
+        # concurrent loads of the same template return the same
+        # instance.
+        registry.lock.acquire()
+        try:
+            template = registry.get(args)
+            if template is None:
+                if hooks:
+                    notify("cache-miss", loader=self, name=args[0])
+                registry[args] = template = func(self, *args, **kwargs)
+            elif hooks:
+                notify("cache-hit", loader=self, name=args[0])
+        finally:
+            registry.lock.release()
         return template
     return load
 
 
+class Registry(object):
+    """Template registry with optional capacity.
+
+    When the number of entries exceeds ``capacity`` or their
+    approximate size exceeds ``max_bytes``, the least recently used
+    templates are evicted. Evicted templates are then tracked using
+    weak references (unless ``weak`` is false) such that a template
+    which is still in use elsewhere is reused if requested again.
+
+    The registry is thread-safe; all operations are guarded by
+    ``lock``.
+    """
+
+    def __init__(self, capacity=None, max_bytes=None, weak=True):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.weak = weakref.WeakValueDictionary() if weak else None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            return key in self.entries
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = get_size(value)
+
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+
+            while self.entries and (
+                (self.capacity is not None and
+                 len(self.entries) > self.capacity) or
+                (self.max_bytes is not None and
+                 self.bytes > self.max_bytes and len(self.entries) > 1)):
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                # Reinsert entry at the end (most recently used)
+                self.entries[key] = value
+            elif self.weak is not None:
+                value = self.weak.pop(key, None)
+                if value is not None:
+                    self[key] = value
+
+            if value is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """Evict least recently used entry."""
+
+        self.lock.acquire()
+        try:
+            key, value = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(key)
+            self.evictions += 1
+
+            if self.weak is not None:
+                self.weak[key] = value
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.sizes.clear()
+            if self.weak is not None:
+                self.weak.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def items(self):
+        """Return list of entries, including evicted entries which
+        are still referenced."""
+
+        self.lock.acquire()
+        try:
+            items = list(self.entries.items())
+            if self.weak is not None:
+                items.extend(self.weak.items())
+            return items
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._remove(key)
+            elif self.weak is not None:
+                self.weak.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.bytes,
+                }
+        finally:
+            self.lock.release()
+
+    def _remove(self, key):
+        self.bytes -= self.sizes.pop(key)
+        return self.entries.pop(key)
+
+
+class DependencyGraph(object):
+    """Static dependencies between templates.
+
+    Templates are identified by filename. For each template, the
+    templates it depends on (e.g. a layout used with a literal
+    ``load:`` expression) and the names of the modules it imports are
+    recorded.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.modules = {}
+        self.dependents = {}
+
+    def __contains__(self, filename):
+        return filename in self.templates
+
+    def add(self, filename, templates=(), modules=()):
+        self.remove(filename)
+        self.templates[filename] = set(templates)
+        self.modules[filename] = set(modules)
+
+        for dependency in templates:
+            self.dependents.setdefault(dependency, set()).add(filename)
+
+    def remove(self, filename):
+        for dependency in self.templates.pop(filename, ()):
+            dependents = self.dependents[dependency]
+            dependents.discard(filename)
+            if not dependents:
+                del self.dependents[dependency]
+
+        self.modules.pop(filename, None)
+
+    def get_dependencies(self, filename, recursive=False):
+        """Return sorted filenames of the templates which the template
+        depends on (directly, unless ``recursive`` is set)."""
+
+        return self._find(self.templates, filename, recursive)
+
+    def get_dependents(self, filename, recursive=False):
+        """Return sorted filenames of the templates which depend on
+        the template (directly, unless ``recursive`` is set)."""
+
+        return self._find(self.dependents, filename, recursive)
+
+    def get_modules(self, filename):
+        return sorted(self.modules.get(filename, ()))
+
+    def _find(self, mapping, filename, recursive):
+        found = set()
+        remaining = [filename]
+
+        while remaining:
+            for name in mapping.get(remaining.pop(), ()):
+                if name not in found and name != filename:
+                    found.add(name)
+                    if recursive:
+                        remaining.append(name)
+
+        return sorted(found)
+
+
+def get_size(template):
+    """Return approximate size of template (in bytes).
+
+    This is the size of the template source file (if any).
+    """
+
+    filename = getattr(template, 'filename', None)
+    try:
+        return os.path.getsize(filename)
+    except (TypeError, OSError):
+        return 0
+
+
+# Resolved asset specifications
+asset_cache = {}
+
+
 def abspath_from_asset_spec(spec):
+    try:
+        return asset_cache[spec]
+    except KeyError:
+        pass
+
     pname, filename = spec.split(':', 1)
-    return pkg_resources.resource_filename(pname, filename)
+    path = asset_cache[spec] = pkg_resources.resource_filename(
+        pname, filename)
+    return path
 
 if os.name == "nt":
     def abspath_from_asset_spec(spec, f=abspath_from_asset_spec):
@@ -45,28 +327,168 @@ class TemplateLoader(object):
     an extension already (i.e. no dot), provide this as
     ``default_extension`` (e.g. ``'.pt'``).
 
+    Template filenames are resolved using an index of the search
+    path directories; both found and missing templates are
+    remembered (up to ``resolve_capacity`` filenames). A missing
+    template is looked up again when one of the directories in which
+    it was searched for is modified. If templates are reloaded
+    automatically (``auto_reload``), the index is refreshed at the
+    interval given by ``refresh_interval`` (in seconds).
+
+    To limit the number of templates kept by the loader, provide a
+    ``capacity`` and/or a maximum approximate size ``max_bytes``; the
+    least recently used templates are evicted first (see
+    ``Registry``).
+
+    The static dependencies of the loaded templates are recorded in
+    ``graph`` (see ``DependencyGraph``). Use ``preload`` to compile a
+    template and its dependencies up front and ``invalidate`` to
+    remove a template and the templates which depend on it.
+
     Additional keyword-arguments will be passed on to the template
     constructor.
     """
 
     default_extension = None
 
-    def __init__(self, search_path=None, default_extension=None, **kwargs):
+    # Maximum number of templates to keep (no limit if ``None``)
+    capacity = None
+
+    # Maximum approximate size in bytes of the templates to keep (no
+    # limit if ``None``)
+    max_bytes = None
+
+    # Interval in seconds at which the search path index is refreshed
+    # when templates are reloaded automatically
+    refresh_interval = 1.0
+
+    # Maximum number of resolved filenames to remember
+    resolve_capacity = 1000
+
+    def __init__(self, search_path=None, default_extension=None,
+                 capacity=None, max_bytes=None, **kwargs):
         if search_path is None:
             search_path = []
         if isinstance(search_path, string_type):
             search_path = [search_path]
         if default_extension is not None:
             self.default_extension = ".%s" % default_extension.lstrip('.')
+        if capacity is not None:
+            self.capacity = capacity
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
         self.search_path = search_path
-        self.registry = {}
+        self.registry = Registry(self.capacity, self.max_bytes)
+        self.graph = DependencyGraph()
         self.kwargs = kwargs
+        self.refresh()
+
+    @property
+    def stats(self):
+        """Return registry statistics.
+
+        This is a dictionary with the number of ``entries``, cache
+        ``hits``, ``misses`` and ``evictions`` and the approximate
+        size in ``bytes`` of the loaded templates.
+        """
+
+        return self.registry.stats()
+
+    @property
+    def auto_reload(self):
+        return self.kwargs.get('auto_reload', AUTO_RELOAD)
 
     @cache
     def load(self, spec, cls=None):
         if cls is None:
             raise ValueError("Unbound template loader.")
 
+        path = self.resolve(spec)
+        if path is None:
+            raise ValueError("Template not found: %s." % spec.strip())
+
+        return cls(path, **self.kwargs)
+
+    def preload(self, spec, cls=None):
+        """Load and compile template and (recursively) the templates
+        which it depends on.
+
+        The dependencies are recorded in the dependency graph.
+        """
+
+        template = TemplateLoader.load(self, spec, cls)
+        self._record(template, set())
+        return template
+
+    def invalidate(self, spec):
+        """Remove template and the templates which depend on it
+        (recursively) from the registry.
+
+        Returns the filenames of the invalidated templates.
+        """
+
+        filename = self.resolve(spec)
+        if filename is None:
+            return []
+
+        # The dependencies of a template are known once it's compiled
+        seen = set()
+        for key, template in self.registry.items():
+            if template._cooked:
+                self._record(template, seen)
+
+        filenames = [filename] + self.graph.get_dependents(
+            filename, recursive=True
+            )
+
+        for key, template in self.registry.items():
+            if template.filename in filenames:
+                self.registry.remove(key)
+
+        for filename in filenames:
+            self.graph.remove(filename)
+
+        return filenames
+
+    def get_dependencies(self, spec, recursive=False):
+        """Return filenames of the templates which the template
+        depends on (see ``DependencyGraph``)."""
+
+        return self.graph.get_dependencies(self.resolve(spec), recursive)
+
+    def get_dependents(self, spec, recursive=False):
+        """Return filenames of the templates which depend on the
+        template (see ``DependencyGraph``)."""
+
+        return self.graph.get_dependents(self.resolve(spec), recursive)
+
+    def resolve(self, spec):
+        """Return absolute filename for ``spec`` or ``None`` if the
+        template was not found."""
+
+        if self.auto_reload and \
+               time() - self._refreshed >= self.refresh_interval:
+            self.refresh()
+
+        entry = self._resolved.get(spec)
+        if entry is not None:
+            path, directories = entry
+            if path is not None or not self._modified(directories):
+                return path
+
+        directories = []
+        path = self._resolve(spec, directories)
+        self._resolved[spec] = path, tuple(directories)
+        return path
+
+    def refresh(self):
+        """Clear search path index and resolved filenames."""
+
+        self._resolved = Registry(self.resolve_capacity, weak=False)
+        self._listings = {}
+        self._refreshed = time()
+
+    def _resolve(self, spec, directories=None):
         spec = spec.strip()
 
         if self.default_extension is not None and '.' not in spec:
@@ -76,19 +498,149 @@ class TemplateLoader(object):
             spec = abspath_from_asset_spec(spec)
 
         if os.path.isabs(spec):
-            return cls(spec, **self.kwargs)
+            return spec
 
         for path in self.search_path:
             path = os.path.join(path, spec)
-            if os.path.exists(path):
-                return cls(path, **self.kwargs)
+            if self._exists(path):
+                return path
+            if directories is not None:
+                directories.append(os.path.dirname(path))
+
+    def _exists(self, path):
+        directory, name = os.path.split(path)
+
+        try:
+            mtime, listing = self._listings[directory]
+        except KeyError:
+            mtime = self._get_mtime(directory)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                names = ()
 
-        raise ValueError("Template not found: %s." % spec)
+            listing = set(os.path.normcase(name) for name in names)
+            self._listings[directory] = mtime, listing
+
+        return os.path.normcase(name) in listing
+
+    def _get_mtime(self, directory):
+        try:
+            return os.stat(directory).st_mtime
+        except OSError:
+            return None
+
+    def _modified(self, directories):
+        """Return true if any of ``directories`` was modified since it
+        was listed (its listing is then discarded)."""
+
+        modified = False
+        for directory in directories:
+            entry = self._listings.get(directory)
+            if entry is None or entry[0] != self._get_mtime(directory):
+                self._listings.pop(directory, None)
+                modified = True
+
+        return modified
+
+    def _record(self, template, seen):
+        if template.filename in seen:
+            return
+
+        seen.add(template.filename)
+
+        get_dependencies = getattr(template, 'get_dependencies', None)
+        if get_dependencies is None:
+            template.cook_check()
+            templates = ()
+        else:
+            templates = get_dependencies()
+
+        get_imports = getattr(template, 'get_imports', None)
+        modules = get_imports() if get_imports is not None else ()
+
+        self.graph.add(
+            template.filename,
+            [dependency.filename for dependency in templates],
+            modules,
+            )
+
+        for dependency in templates:
+            self._record(dependency, seen)
 
     def bind(self, cls):
         return functools.partial(self.load, cls=cls)
 
 
+def preload(loader, patterns, freeze=False):
+    """Load and compile the templates of a template loader which match
+    one of ``patterns`` and prepare them for use in forked processes.
+
+    The patterns are matched against the filenames relative to the
+    directories of the loader's search path (using ``fnmatch``, where
+    a ``*`` also matches a path separator), e.g. ``"*.pt"``. A file
+    which can not be compiled (e.g. an image which matches a pattern)
+    is skipped with a warning.
+
+    The templates and the templates they depend on are then compacted
+    (see ``BaseTemplate.compact``). If ``freeze`` is set, the garbage
+    collector moves all objects to a permanent generation which is
+    ignored in collections, such that the memory pages of a
+    prefork server's master process are not written to by its workers
+    when they collect garbage (requires Python 3.7 or newer).
+
+    Returns the loaded templates.
+    """
+
+    if isinstance(patterns, string_type):
+        patterns = patterns,
+
+    templates = []
+    for path in loader.search_path:
+        names = []
+        for directory, dirs, files in os.walk(path):
+            dirs.sort()
+            relative = directory[len(path):].lstrip(os.sep)
+            for name in sorted(files):
+                names.append(os.path.join(relative, name))
+
+        for name in names:
+            spec = name.replace(os.sep, '/')
+            for pattern in patterns:
+                if fnmatch.fnmatch(spec, pattern):
+                    break
+            else:
+                continue
+
+            try:
+                template = loader.preload(name)
+            except Exception:
+                log.warning("could not preload %s." % name, exc_info=True)
+                continue
+
+            templates.append(template)
+
+    seen = set()
+    pending = list(templates)
+    while pending:
+        template = pending.pop()
+        if id(template) in seen:
+            continue
+
+        seen.add(id(template))
+        template.compact()
+
+        get_dependencies = getattr(template, 'get_dependencies', None)
+        if get_dependencies is not None:
+            pending.extend(get_dependencies())
+
+    gc.collect()
+    if freeze and hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    return templates
+
+
 class MemoryLoader(object):
     def build(self, source, filename):
         code = compile(source, filename, 'exec')
@@ -97,13 +649,98 @@ class MemoryLoader(object):
         return env
 
     def get(self, name):
+        if hooks:
+            notify("cache-miss", loader=self, name=name)
         return None
 
 
+class FileLock(object):
+    """Exclusive lock shared between processes, using a lock file.
+
+    This is a no-op on platforms which do not support ``flock``.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def acquire(self):
+        """Acquire lock; returns true if another process (or thread)
+        held the lock in the meantime."""
+
+        if fcntl is None:
+            return False
+
+        self.file = open(self.filename, 'a')
+        try:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+                return True
+            return False
+        except:
+            self.file.close()
+            self.file = None
+            raise
+
+    def release(self):
+        if self.file is None:
+            return
+
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.file.close()
+            self.file = None
+
+
 class ModuleLoader(object):
-    def __init__(self, path, remove=False):
+    """Load template modules from a cache directory.
+
+    The modules are stored in subdirectories (shards) named after the
+    first characters of a hash of the module filename, to keep
+    directories small.
+
+    The loader keeps an index of the cached modules with their size
+    and time of last access (recorded on disk as the modification
+    time). If the number of modules exceeds ``max_entries`` or their
+    total size exceeds ``max_bytes``, the least recently used modules
+    are removed when a module is added (see ``prune``). The time of
+    last access is recorded only if one of these limits is set, and
+    at most once per ``touch_interval`` seconds.
+
+    The cache directory also holds a metadata index which maps a key
+    to a value (e.g. the metadata of a template file to the digest of
+    its module), see ``get_metadata``.
+    """
+
+    # Maximum number of modules in the cache directory (no limit if
+    # ``None``)
+    max_entries = None
+
+    # Maximum total size in bytes of the modules in the cache
+    # directory (no limit if ``None``)
+    max_bytes = None
+
+    # Minimum number of seconds between updates of the time of last
+    # access of a module
+    touch_interval = 3600
+
+    def __init__(self, path, remove=False, max_entries=None, max_bytes=None):
         self.path = path
         self.remove = remove
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._metadata = None
+        self._metadata_lock = threading.Lock()
+
+        # Modules loaded from the cache directory which are in use
+        self.modules = weakref.WeakValueDictionary()
 
     def __del__(self, shutil=shutil):
         if not self.remove:
@@ -114,60 +751,677 @@ class ModuleLoader(object):
             warnings.warn("Could not clean up temporary file path: %s" % (self.path,))
 
     def get(self, filename):
-        path = os.path.join(self.path, filename)
-        if os.path.exists(path):
+        path = self._get_path(filename)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime is not None:
             log.debug("loading module from cache: %s." % filename)
             base, ext = os.path.splitext(filename)
-            return self._load(base, path)
-        else:
-            log.debug('cache miss: %s' % filename)
+            try:
+                module = self._load(base, path)
+            except (IOError, OSError):
+                # The module was removed in the meantime
+                pass
+            else:
+                if hooks:
+                    notify("cache-hit", loader=self, name=filename)
+                self._touch(path, mtime)
+                return module
+
+        log.debug('cache miss: %s' % filename)
+        if hooks:
+            notify("cache-miss", loader=self, name=filename)
 
     def build(self, source, filename):
-        imp.acquire_lock()
+        base, ext = os.path.splitext(filename)
+        name = self._get_path(base + ".py")
+
+        lock = get_module_lock(base)
+        lock.acquire()
         try:
-            d = self.get(filename)
-            if d is not None:
-                return d
+            # Another thread may have built the module in the meantime
+            if os.path.exists(name):
+                return self._load(base, name)
 
-            base, ext = os.path.splitext(filename)
-            name = os.path.join(self.path, base + ".py")
+            self._mkdir(os.path.dirname(name))
+            self._write(source, base, name)
+            module = self._load(base, name)
+        finally:
+            lock.release()
+
+        self._add(name)
+        return module
+
+    def get_lock(self, filename):
+        """Return lock on module ``filename`` (see ``FileLock``).
+
+        Processes which share the cache directory hold the lock while
+        compiling a template into the module such that it's compiled
+        by one process at a time. The lock file is never removed
+        since another process may be waiting for it.
+        """
+
+        base, ext = os.path.splitext(filename)
+        path = os.path.splitext(self._get_path(base + ".py"))[0]
+        self._mkdir(os.path.dirname(path))
+        return FileLock(path + ".lock")
 
-            log.debug("writing source to disk (%d bytes)." % len(source))
-            fd, fn = tempfile.mkstemp(prefix=base, suffix='.tmp', dir=self.path)
-            temp = os.fdopen(fd, 'wb')
-            encoded = source.encode('utf-8')
-            header = encode_string("# -*- coding: utf-8 -*-" + "\n")
+    def prune(self, max_entries=None, max_bytes=None, max_age=None):
+        """Remove the least recently used modules until there are at
+        most ``max_entries`` modules of at most ``max_bytes`` in total,
+        and modules which have not been used for ``max_age`` seconds.
 
+        Modules written by versions which did not use shards are
+        included. Returns the filenames of the removed modules.
+        """
+
+        self._index_lock.acquire()
+        try:
+            self._index = self._scan()
+            removed = self._prune(max_entries, max_bytes, max_age)
+        finally:
+            self._index_lock.release()
+
+        self._compact_metadata()
+        return removed
+
+    def stats(self):
+        """Return number of ``entries`` and total size in ``bytes`` of
+        the modules in the cache directory."""
+
+        self._index_lock.acquire()
+        try:
+            self._index = index = self._scan()
+            return {
+                'entries': len(index),
+                'bytes': sum(size for size, mtime in index.values()),
+                }
+        finally:
+            self._index_lock.release()
+
+    def bundle(self, filename):
+        """Write the modules in the cache directory to a bundle file
+        (see ``BundleLoader``). Returns the number of modules."""
+
+        self._index_lock.acquire()
+        try:
+            self._index = index = self._scan()
+            paths = list(index)
+        finally:
+            self._index_lock.release()
+
+        modules = []
+        for path in paths:
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                continue
+            try:
+                modules.append((os.path.basename(path), f.read()))
+            finally:
+                f.close()
+
+        write_bundle(filename, modules)
+        return len(modules)
+
+    def get_metadata(self, key):
+        """Return value recorded for ``key`` in the metadata index or
+        ``None`` if not found.
+
+        The index is read from the cache directory on first use.
+        """
+
+        self._metadata_lock.acquire()
+        try:
+            if self._metadata is None:
+                self._metadata = self._read_metadata()
+            return self._metadata.get(self._get_metadata_key(key))
+        finally:
+            self._metadata_lock.release()
+
+    def set_metadata(self, key, value):
+        """Record ``value`` (a string) for ``key`` in the metadata
+        index."""
+
+        key = self._get_metadata_key(key)
+        line = "%s\t%s\n" % (key, value)
+
+        self._metadata_lock.acquire()
+        try:
+            if self._metadata is None:
+                self._metadata = self._read_metadata()
+            if self._metadata.get(key) == value:
+                return
+            self._metadata[key] = value
+
+            # Processes which share the cache directory append to the
+            # index (a short write is atomic)
             try:
+                f = open(self._get_metadata_path(), 'ab')
                 try:
-                    temp.write(header)
-                    temp.write(encoded)
+                    f.write(line.encode('utf-8'))
                 finally:
-                    temp.close()
+                    f.close()
+            except (IOError, OSError):
+                log.warn("could not write to metadata index.")
+        finally:
+            self._metadata_lock.release()
+
+    def _get_metadata_path(self):
+        return os.path.join(self.path, "metadata")
+
+    def _get_metadata_key(self, key):
+        if not isinstance(key, byte_string):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _read_metadata(self):
+        metadata = {}
+        try:
+            f = open(self._get_metadata_path(), 'rb')
+        except IOError:
+            return metadata
+
+        try:
+            for line in f:
+                line = line.decode('utf-8')
+                if not line.endswith('\n'):
+                    # The line is being written
+                    continue
+                key, value = line[:-1].split('\t', 1)
+                metadata[key] = value
+        finally:
+            f.close()
+
+        return metadata
+
+    def _compact_metadata(self):
+        # Rewrite the metadata index with one entry per key
+        path = self._get_metadata_path()
+        if not os.path.exists(path):
+            return
+
+        self._metadata_lock.acquire()
+        try:
+            self._metadata = metadata = self._read_metadata()
+            fd, fn = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            f = os.fdopen(fd, 'wb')
+            try:
+                try:
+                    for key, value in sorted(metadata.items()):
+                        f.write(("%s\t%s\n" % (key, value)).encode('utf-8'))
+                finally:
+                    f.close()
             except:
                 os.remove(fn)
                 raise
 
-            os.rename(fn, name)
-            log.debug("compiling %s into byte-code..." % filename)
-            py_compile.compile(name)
+            if os.name == 'nt':
+                os.remove(path)
+            os.rename(fn, path)
+        finally:
+            self._metadata_lock.release()
 
-            return self._load(base, name)
+    def _mkdir(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                # Another process may have created the directory
+                if not os.path.isdir(directory):
+                    raise
+
+    def _get_path(self, filename):
+        shard = hashlib.sha1(encode_string(filename)).hexdigest()[:2]
+        return os.path.join(self.path, shard, filename)
+
+    def _add(self, path):
+        if self.max_entries is None and self.max_bytes is None:
+            return
+
+        self._index_lock.acquire()
+        try:
+            if self._index is None:
+                self._index = self._scan()
+            try:
+                self._index[path] = os.path.getsize(path), time()
+            except OSError:
+                pass
+
+            removed = self._prune(self.max_entries, self.max_bytes)
+            if removed:
+                log.debug("pruned %d modules from cache directory: %s." % (
+                    len(removed), self.path))
         finally:
-            imp.release_lock()
+            self._index_lock.release()
+
+    def _prune(self, max_entries, max_bytes, max_age=None):
+        index = self._index
+        removed = []
+
+        if max_age is not None:
+            expired = time() - max_age
+            for path, (size, mtime) in list(index.items()):
+                if mtime >= expired:
+                    break
+                removed.append(path)
+                self._remove(path)
+
+        total = sum(size for size, mtime in index.values())
+        for path in list(index):
+            if not (
+                (max_entries is not None and len(index) > max_entries) or
+                (max_bytes is not None and total > max_bytes)):
+                break
+            total -= index[path][0]
+            removed.append(path)
+            self._remove(path)
+
+        return removed
+
+    def _touch(self, path, mtime):
+        # The modification time records the last access; it's used
+        # only to prune the cache directory
+        if self.max_entries is None and self.max_bytes is None:
+            return
+
+        now = time()
+        if now - mtime < self.touch_interval:
+            return
 
-    def _load(self, base, filename):
-        imp.acquire_lock()
         try:
-            module = sys.modules.get(base)
-            if module is None:
-                f = open(filename, 'rb')
+            os.utime(path, None)
+        except OSError:
+            return
+
+        if self._index is not None:
+            self._index_lock.acquire()
+            try:
+                entry = self._index.pop(path, None)
+                if entry is not None:
+                    self._index[path] = entry[0], now
+            finally:
+                self._index_lock.release()
+
+    def _scan(self):
+        """Return index of modules (ordered by time of last access)."""
+
+        entries = []
+        directories = [self.path]
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if len(name) == 2 and os.path.isdir(path):
+                directories.append(path)
+
+        for directory in directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+
+            for name in names:
+                if not name.endswith('.py'):
+                    continue
+                path = os.path.join(directory, name)
                 try:
-                    assert base not in sys.modules
-                    module = imp.load_source(base, filename, f)
-                finally:
-                    f.close()
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+
+        entries.sort()
+        return OrderedDict(
+            (path, (size, mtime)) for mtime, path, size in entries
+            )
+
+    def _remove(self, path):
+        del self._index[path]
+        base = os.path.splitext(path)[0]
+        directory, name = os.path.split(base)
+        names = [path, base + ".pyc"]
+
+        # Byte-code written by Python 3 for modules which were
+        # imported using ``imp``
+        cache = os.path.join(directory, "__pycache__")
+        if os.path.isdir(cache):
+            for filename in os.listdir(cache):
+                if filename.split('.', 1)[0] == name:
+                    names.append(os.path.join(cache, filename))
+
+        for filename in names:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def _write(self, source, base, name):
+        log.debug("writing source to disk (%d bytes)." % len(source))
+        directory = os.path.dirname(name)
+        fd, fn = tempfile.mkstemp(prefix=base, suffix='.tmp', dir=directory)
+        temp = os.fdopen(fd, 'wb')
+        encoded = source.encode('utf-8')
+        header = encode_string("# -*- coding: utf-8 -*-" + "\n")
+
+        try:
+            try:
+                temp.write(header)
+                temp.write(encoded)
+            finally:
+                temp.close()
+        except:
+            os.remove(fn)
+            raise
+
+        os.rename(fn, name)
+
+    def unload(self, filename):
+        """Stop tracking the module such that it's loaded again from
+        the cache directory.
+
+        Note that a module is tracked only for as long as a template
+        uses it.
+        """
+
+        base, ext = os.path.splitext(filename)
+        self.modules.pop(base, None)
+
+    def _load(self, base, filename):
+        lock = get_module_lock(base)
+        lock.acquire()
+        try:
+            module = self.modules.get(base)
+            if module is not None:
+                return module.env
+
+            if DEBUG_MODE:
+                env = sys.modules.get(base)
+                env = env.__dict__ if env is not None else None
+            else:
+                env = None
+
+            if env is None:
+                env = load_module(base, filename)
+
+            self.modules[base] = LoadedModule(env)
+        finally:
+            lock.release()
+
+        return env
+
+
+class BundleLoader(object):
+    """Load template modules from a bundle file.
+
+    A bundle contains the compiled code of a set of template modules
+    (see ``write_bundle``). The file is mapped into memory such that
+    its pages are shared between processes; a module is unmarshalled
+    only when it's first used.
+
+    Modules which are not in the bundle are built using ``loader``
+    (by default, in memory). If the loader keeps a metadata index
+    (see ``ModuleLoader.get_metadata``), it's used to look up the
+    modules of unchanged template files.
+
+    A bundle written by another Python version is ignored (with a
+    warning) since the code objects are not compatible.
+    """
+
+    def __init__(self, filename, loader=None):
+        self.filename = filename
+        self.loader = loader if loader is not None else MemoryLoader()
+        self.modules = weakref.WeakValueDictionary()
+
+        get_metadata = getattr(self.loader, 'get_metadata', None)
+        if get_metadata is not None:
+            self.get_metadata = get_metadata
+            self.set_metadata = self.loader.set_metadata
+
+        get_lock = getattr(self.loader, 'get_lock', None)
+        if get_lock is not None:
+            self.get_lock = get_lock
+
+        f = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        self.index = read_bundle_index(self.map)
+        if self.index is None:
+            warnings.warn("Ignoring incompatible template bundle: %s." % (
+                filename,))
+            self.index = {}
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, filename):
+        entry = self.index.get(filename)
+        if entry is None:
+            return self.loader.get(filename)
+
+        if hooks:
+            notify("cache-hit", loader=self, name=filename)
+
+        base, ext = os.path.splitext(filename)
+        lock = get_module_lock(base)
+        lock.acquire()
+        try:
+            module = self.modules.get(base)
+            if module is not None:
+                return module.env
+
+            offset, length = entry
+            log.debug("loading module %s from bundle." % filename)
+            code = marshal.loads(self.map[offset:offset + length])
+            env = {'__name__': base}
+            exec(code, env)
+            self.modules[base] = LoadedModule(env)
         finally:
-            imp.release_lock()
+            lock.release()
+
+        return env
+
+    def build(self, source, filename):
+        return self.loader.build(source, filename)
+
+
+class LoadedModule(object):
+    """Tracks the namespace of a loaded module.
+
+    The namespace refers to this object such that a weak reference to
+    it is valid for as long as the namespace is in use (e.g. by the
+    functions of a template).
+    """
+
+    def __init__(self, env):
+        self.env = env
+        env['__loaded'] = self
+
+
+# Locks for module names (a name is mapped to one of these)
+module_locks = tuple(threading.RLock() for i in range(64))
+
+
+def get_module_lock(name):
+    """Return lock for the module ``name``.
+
+    The lock is held while the module is written and loaded. Unlike
+    the interpreter-wide import lock, this does not block the import
+    of other modules.
+    """
+
+    return module_locks[hash(name) % len(module_locks)]
+
+
+def load_module(name, filename):
+    """Execute module source file and return the module namespace.
+
+    The module is added to ``sys.modules`` only in debug mode (to make
+    it available to a debugger); otherwise, it is freed once it's no
+    longer used.
+    """
+
+    log.debug("loading module %s from %s." % (name, filename))
 
+    code = read_bytecode(filename)
+    if code is None:
+        f = open(filename, 'rb')
+        try:
+            source = f.read()
+        finally:
+            f.close()
+
+        code = compile(source, filename, 'exec')
+        write_bytecode(filename, code, len(source))
+
+    if DEBUG_MODE:
+        module = types.ModuleType(native_string(name))
+        module.__file__ = filename
+        exec(code, module.__dict__)
+        sys.modules[name] = module
         return module.__dict__
+
+    env = {'__name__': name, '__file__': filename}
+    exec(code, env)
+    return env
+
+
+# The header of a byte-code file gives the size of the module source
+# file. The modification time of a module records its last access
+# (see ``ModuleLoader``); a module is named after a digest of its
+# source and is never changed once written.
+bytecode_header = struct.Struct("<Q")
+
+
+def read_bytecode(filename):
+    """Return code object of module source file ``filename`` from its
+    byte-code file, or ``None`` if it's missing or stale."""
+
+    try:
+        f = open(filename + "c", 'rb')
+    except IOError:
+        return None
+
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    header = bytecode_magic + bytecode_header.pack(os.path.getsize(filename))
+    if not data.startswith(header):
+        return None
+
+    try:
+        return marshal.loads(data[len(header):])
+    except (ValueError, EOFError, TypeError):
+        return None
+
+
+def write_bytecode(filename, code, size):
+    """Write byte-code file for module source file ``filename`` (of
+    ``size`` bytes). Errors are ignored, e.g. if the cache directory
+    is read-only."""
+
+    directory, name = os.path.split(filename)
+    try:
+        fd, fn = tempfile.mkstemp(prefix=name, suffix='.tmp', dir=directory)
+    except OSError:
+        return
+
+    f = os.fdopen(fd, 'wb')
+    try:
+        try:
+            f.write(bytecode_magic)
+            f.write(bytecode_header.pack(size))
+            f.write(marshal.dumps(code))
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(filename + "c"):
+            os.remove(filename + "c")
+        os.rename(fn, filename + "c")
+    except (IOError, OSError):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+
+# The bundle header; the compiled code is specific to the Python
+# implementation and version
+bundle_magic = encode_string("CHAMELEON-BUNDLE\n")
+bundle_tag = encode_string("%s %d.%d\n" % (
+    (platform.python_implementation(), ) + sys.version_info[:2]))
+
+# The trailer gives the offset of the index
+bundle_trailer = struct.Struct("<Q")
+
+
+def write_bundle(filename, modules):
+    """Write a bundle of template modules to ``filename``.
+
+    The ``modules`` argument is a sequence of module filename and
+    source code pairs (e.g. as written to a cache directory by the
+    module loader). The bundle consists of a header, the marshalled
+    code objects and an index which maps each module filename to the
+    offset and length of its code.
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, fn = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    f = os.fdopen(fd, 'wb')
+
+    try:
+        try:
+            f.write(bundle_magic)
+            f.write(bundle_tag)
+            offset = len(bundle_magic) + len(bundle_tag)
+            index = {}
+
+            for name, source in modules:
+                if not isinstance(source, byte_string):
+                    source = encode_string(
+                        "# -*- coding: utf-8 -*-\n") + source.encode('utf-8')
+                code = compile(source, name, 'exec')
+                data = marshal.dumps(code)
+                f.write(data)
+                index[name] = offset, len(data)
+                offset += len(data)
+
+            f.write(marshal.dumps(index))
+            f.write(bundle_trailer.pack(offset))
+        finally:
+            f.close()
+    except:
+        os.remove(fn)
+        raise
+
+    os.chmod(fn, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+
+    # Replace the bundle in one step (processes which have mapped the
+    # previous file keep using it)
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(fn, filename)
+
+
+def read_bundle_index(data):
+    """Return the index of a bundle, or ``None`` if the bundle was
+    written by another Python version."""
+
+    start = len(bundle_magic)
+    if data[:start] != bundle_magic:
+        raise ValueError("Not a template bundle.")
+
+    if data[start:start + len(bundle_tag)] != bundle_tag:
+        return None
+
+    end = len(data) - bundle_trailer.size
+    offset, = bundle_trailer.unpack(data[end:])
+    return marshal.loads(data[offset:end])
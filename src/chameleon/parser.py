@@ -15,12 +15,12 @@ match_tag_prefix_and_name = re.compile(
     '(?P<suffix>(?P<space>\s*)/?>)?',
     re.UNICODE | re.DOTALL)
 match_single_attribute = re.compile(
-    r'(?P<space>\s+)(?!\d)'
-    r'(?P<name>[^ =/>\n\t]+)'
-    r'((?P<eq>\s*=\s*)'
-    r'((?P<quote>[\'"])(?P<value>.*?)(?P=quote)|'
-    r'(?P<alt_value>[^\s\'">/]+))|'
-    r'(?P<simple_value>(?![ \\n\\t\\r]*=)))',
+    r'(\s+)(?!\d)'
+    r'([^ =/>\n\t]+)'
+    r'(?:(\s*=\s*)'
+    r'(?:"([^"]*)"|\'([^\']*)\'|'
+    r'([^\s\'">/]+))|'
+    r'(?![ \\n\\t\\r]*=))',
     re.UNICODE | re.DOTALL)
 match_comment = re.compile(
     r'^<!--(?P<text>.*)-->$', re.DOTALL)
@@ -69,35 +69,123 @@ def groupdict(m, token):
     return d
 
 
+class Attribute(object):
+    """Attribute of a tag.
+
+    The attribute is a record of the tag token and the spans of the
+    groups matched by ``match_single_attribute`` (space, name, equal
+    sign and double-quoted, single-quoted or unquoted value). Each
+    token is created when it's first accessed using the dictionary
+    interface, with the keys ``space``, ``name``, ``eq``, ``quote``
+    and ``value``; the equal sign, quote and value are empty strings
+    if not given.
+    """
+
+    __slots__ = "token", "spans", "tokens"
+
+    fields = "space", "name", "eq", "quote", "value"
+
+    index = dict((key, i) for i, key in enumerate(fields))
+
+    def __init__(self, token, spans):
+        self.token = token
+        self.spans = spans
+        self.tokens = None
+
+    def __getitem__(self, key):
+        tokens = self.tokens
+        if tokens is None:
+            tokens = self.tokens = [None] * len(self.fields)
+
+        i = self.index[key]
+        value = tokens[i]
+        if value is None:
+            value = tokens[i] = self.make(i)
+        return value
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, dict(self.items()))
+
+    def get(self, key, default=None):
+        if key in self.index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return [(key, self[key]) for key in self.fields]
+
+    def is_xmlns(self):
+        """Return true if the attribute name has the ``xmlns`` prefix
+        (checked without creating the token)."""
+
+        i, j = self.spans[2]
+        return self.token.startswith('xmlns', i, j)
+
+    def make(self, index):
+        """Return token of the field at ``index``."""
+
+        token = self.token
+        spans = self.spans
+
+        # The space and name are always given
+        if index < 2:
+            i, j = spans[index + 1]
+            return token[i:j]
+
+        i, j = spans[3]
+        if i < 0:
+            return ''
+        if index == 2:
+            return token[i:j]
+
+        for i, j in spans[4:6]:
+            if i >= 0:
+                if index == 3:
+                    return token[i - 1:i]
+                return token[i:j]
+
+        if index == 3:
+            return ''
+        i, j = spans[6]
+        return token[i:j]
+
+
 def match_tag(token, regex=match_tag_prefix_and_name):
     m = regex.match(token)
     d = groupdict(m, token)
 
-    end = m.end()
-    token = token[end:]
-
     attrs = d['attrs'] = []
-    for m in match_single_attribute.finditer(token):
-        attr = groupdict(m, token)
-        alt_value = attr.pop('alt_value', None)
-        if alt_value is not None:
-            attr['value'] = alt_value
-            attr['quote'] = ''
-        simple_value = attr.pop('simple_value', None)
-        if simple_value is not None:
-            attr['quote'] = ''
-            attr['value'] = ''
-            attr['eq'] = ''
-        attrs.append(attr)
-        d['suffix'] = token[m.end():]
+    end = None
+    for m in match_single_attribute.finditer(token, m.end()):
+        attrs.append(Attribute(token, m.regs))
+        end = m.end()
+
+    if end is not None:
+        d['suffix'] = token[end:]
 
     return d
 
 
 def parse_tag(token, namespace):
+    """Parse tag ``token`` using the ``namespace`` mapping.
+
+    Returns the node and the namespace mapping which applies to the
+    element (and its descendants). This is ``namespace`` itself unless
+    the tag declares namespaces.
+    """
+
     node = match_tag(token)
 
-    update_namespace(node['attrs'], namespace)
+    namespace = update_namespace(node['attrs'], namespace)
 
     if ':' in node['name']:
         prefix = node['name'].split(':')[0]
@@ -109,19 +197,33 @@ def parse_tag(token, namespace):
     node['ns_attrs'] = unpack_attributes(
         node['attrs'], namespace, default)
 
-    return node
+    return node, namespace
 
 
 def update_namespace(attributes, namespace):
     # possibly update namespaces; we do this in a separate step
-    # because this assignment is irrespective of order
+    # because this assignment is irrespective of order. The mapping
+    # is shared with the parent element and copied on write.
+    copied = False
     for attribute in attributes:
+        if not attribute.is_xmlns():
+            continue
+
         name = attribute['name']
-        value = attribute['value']
         if name == 'xmlns':
-            namespace[None] = value
+            prefix = None
         elif name.startswith('xmlns:'):
-            namespace[name[6:]] = value
+            prefix = name[6:]
+        else:
+            continue
+
+        if not copied:
+            namespace = namespace.copy()
+            copied = True
+
+        namespace[prefix] = attribute['value']
+
+    return namespace
 
 
 def unpack_attributes(attributes, namespace, default):
@@ -169,26 +271,82 @@ def identify(string):
 
 
 class ElementParser(object):
-    """Parses tokens into elements."""
-
-    def __init__(self, stream, default_namespaces):
+    """Parses tokens into elements.
+
+    The stream yields tokens or, if the ``source`` string is given,
+    ``(kind, start, end)`` triples (see ``tokenize.scan_xml``) from
+    which tokens are created as they're parsed.
+
+    Open elements are kept on a stack of frames, each with the start
+    tag, the children parsed so far and the namespace mapping of the
+    element (the bottom frame is the document). An element which is
+    not closed (when an end tag for an element further down the stack
+    is parsed) is replaced in its parent by its start tag followed by
+    its children.
+
+    Parsing is incremental: iterating over the parser yields items at
+    the document level as soon as they're complete, such that only the
+    open elements are kept in memory.
+    """
+
+    def __init__(self, stream, default_namespaces, source=None,
+                 filename=None):
         self.stream = stream
+        self.source = source
+        self.filename = filename
         self.queue = []
-        self.index = []
-        self.namespaces = [default_namespaces.copy()]
+        self.stack = [(None, self.queue, default_namespaces.copy())]
+        self.visitors = {}
 
     def __iter__(self):
-        for token in self.stream:
-            item = self.parse(token)
-            self.queue.append(item)
+        queue = self.queue
+        stack = self.stack
+        source = self.source
+        filename = self.filename
+
+        for item in self.stream:
+            if source is None:
+                token, kind = item, None
+            else:
+                kind, start, end = item
+                token = Token(source[start:end], start, source, filename)
+
+            item = self.parse(token, kind)
+            if item is not None:
+                stack[-1][1].append(item)
+
+            # Items at the document level are complete
+            if len(stack) == 1 and queue:
+                for item in queue:
+                    yield item
+                del queue[:]
+
+        self.unwind(0)
+        for item in queue:
+            yield item
+        del queue[:]
+
+    def parse(self, token, kind=None):
+        if kind is None:
+            kind = identify(token)
 
-        return iter(self.queue)
+        try:
+            visitor = self.visitors[kind]
+        except KeyError:
+            visitor = self.visitors[kind] = getattr(
+                self, "visit_%s" % kind, self.visit_default)
 
-    def parse(self, token):
-        kind = identify(token)
-        visitor = getattr(self, "visit_%s" % kind, self.visit_default)
         return visitor(kind, token)
 
+    def unwind(self, depth):
+        # The elements above ``depth`` on the stack are not closed
+        stack = self.stack
+        parent = stack[depth][1]
+        for node, children, namespace in stack[depth + 1:]:
+            parent.append(("start_tag", (node, )))
+            parent.extend(children)
+        del stack[depth + 1:]
+
     def visit_comment(self, kind, token):
         return "comment", (token, )
 
@@ -209,33 +367,24 @@ class ElementParser(object):
         return kind, (token, )
 
     def visit_start_tag(self, kind, token):
-        namespace = self.namespaces[-1].copy()
-        self.namespaces.append(namespace)
-        node = parse_tag(token, namespace)
-        self.index.append((node['name'], len(self.queue)))
-        return kind, (node, )
+        node, namespace = parse_tag(token, self.stack[-1][2])
+        self.stack.append((node, [], namespace))
 
     def visit_end_tag(self, kind, token):
-        try:
-            namespace = self.namespaces.pop()
-        except IndexError:
-            raise ParseError("Unexpected end tag.", token)
-
-        node = parse_tag(token, namespace)
+        stack = self.stack
+        node, namespace = parse_tag(token, stack[-1][2])
+        name = node['name']
 
-        while self.index:
-            name, pos = self.index.pop()
-            if name == node['name']:
-                start, = self.queue.pop(pos)[1]
-                children = self.queue[pos:]
-                del self.queue[pos:]
+        for i in range(len(stack) - 1, 0, -1):
+            if stack[i][0]['name'] == name:
                 break
         else:
             raise ParseError("Unexpected end tag.", token)
 
+        self.unwind(i)
+        start, children, namespace = stack.pop()
         return "element", (start, node, children)
 
     def visit_empty_tag(self, kind, token):
-        namespace = self.namespaces[-1].copy()
-        node = parse_tag(token, namespace)
+        node, namespace = parse_tag(token, self.stack[-1][2])
         return "element", (node, None, [])
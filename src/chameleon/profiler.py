@@ -0,0 +1,209 @@
+"""Template profiler.
+
+Attributes time spent rendering templates to template source
+locations (file, line and element or expression) rather than to the
+generated Python code.
+
+  >>> from chameleon.profiler import Profiler
+  >>> profiler = Profiler()
+  >>> profiler.enable()
+  >>> template(...)
+  >>> profiler.disable()
+  >>> print(profiler.report())
+
+The profiler relies on the location table which the compiler includes
+with a template module if the template has the ``profile`` option set
+(see ``TemplateCodeGenerator``).
+"""
+
+import sys
+import bisect
+
+from time import time
+
+from .utils import unicode_string
+
+
+class Profiler(object):
+    """Line-level template profiler.
+
+    Uses a trace function to measure the time between consecutive
+    line events in template code and charges it to the template
+    source location of the former.
+
+    Time spent in functions called from template code (e.g. Python
+    expressions) is charged to the template location from which they
+    were called.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._tables = {}
+        self._last = None
+        self._last_time = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def enable(self):
+        """Start profiling the current thread."""
+
+        self._last = None
+        self._last_time = time()
+        sys.settrace(self._trace)
+
+    def disable(self):
+        sys.settrace(None)
+        self._charge(None)
+
+        # Release the template modules which were profiled
+        self._tables.clear()
+
+    def clear(self):
+        self.stats.clear()
+        self._tables.clear()
+
+    def report(self, limit=20):
+        """Return report of hottest template locations."""
+
+        total = sum(time for count, time in self.stats.values()) or 1.0
+        locations = {}
+
+        for stack, (count, time) in self.stats.items():
+            entry = locations.setdefault(stack[-1], [0, 0.0])
+            entry[0] += count
+            entry[1] += time
+
+        items = sorted(
+            locations.items(), key=lambda item: item[1][1], reverse=True
+            )
+
+        lines = ["%8s %7s %6s  %s" % ("time", "%", "hits", "location")]
+        for (filename, line, column, text), (count, time) in items[:limit]:
+            lines.append("%8.4f %6.2f%% %6d  %s:%d:%d %s" % (
+                time, 100 * time / total, count,
+                filename or "<string>", line, column, text
+                ))
+
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """Return profile in the collapsed stack format.
+
+        The output can be turned into a flamegraph using for example
+        Brendan Gregg's ``flamegraph.pl`` script.
+        """
+
+        lines = []
+        for stack, (count, time) in sorted(self.stats.items()):
+            frames = [
+                "%s:%d %s" % (filename or "<string>", line, text)
+                for filename, line, column, text in stack
+                ]
+            lines.append("%s %d" % (
+                ";".join(frames).replace(" ", "_"), int(time * 1000000)
+                ))
+
+        return "\n".join(lines)
+
+    def write_collapsed(self, path):
+        f = open(path, 'w')
+        try:
+            f.write(self.collapsed())
+            f.write("\n")
+        finally:
+            f.close()
+
+    def _trace(self, frame, event, arg):
+        if '__locations' not in frame.f_globals:
+            return
+
+        return self._trace_line
+
+    def _trace_line(self, frame, event, arg):
+        if event == 'line':
+            self._charge(frame)
+        elif event == 'return':
+            self._charge(frame.f_back)
+
+        return self._trace_line
+
+    def _charge(self, frame):
+        now = time()
+        last = self._last
+
+        if last is not None:
+            entry = self.stats.get(last)
+            if entry is None:
+                entry = self.stats[last] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += now - self._last_time
+
+        self._last = self._get_stack(frame) if frame is not None else None
+        self._last_time = time()
+
+    def _get_stack(self, frame):
+        stack = []
+
+        while frame is not None:
+            location = self._get_location(frame)
+            if location is not None:
+                stack.append(location)
+            frame = frame.f_back
+
+        if stack:
+            stack.reverse()
+            return tuple(stack)
+
+    def _get_location(self, frame):
+        table = self._get_table(frame.f_globals)
+        if table is None:
+            return
+
+        lines, locations = table
+        index = bisect.bisect_right(lines, frame.f_lineno) - 1
+        if index >= 0:
+            return locations[index]
+
+    def _get_table(self, env):
+        key = id(env)
+
+        try:
+            return self._tables[key][1]
+        except KeyError:
+            pass
+
+        try:
+            name, locations = env['__locations']
+            function = env[name]
+        except KeyError:
+            table = None
+        else:
+            try:
+                code = function.__code__
+            except AttributeError:
+                code = function.func_code
+
+            # With the ``template_lines`` option, line numbers already
+            # refer to the template source.
+            if locations and code.co_filename == locations[0][1]:
+                locations = sorted(locations, key=lambda entry: entry[2:4])
+                lines = [entry[2] for entry in locations]
+            else:
+                offset = code.co_firstlineno
+                lines = [offset + entry[0] for entry in locations]
+
+            table = (
+                lines,
+                [tuple(entry[1:4]) + (unicode_string(entry[4]), )
+                 for entry in locations]
+                )
+
+        # Keep a reference to the environment such that the key remains
+        # unique while we're using it
+        self._tables[key] = env, table
+        return table
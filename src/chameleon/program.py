@@ -5,6 +5,7 @@ except NameError:
 
 from .tokenize import iter_xml
 from .tokenize import iter_text
+from .tokenize import scan_xml
 from .parser import ElementParser
 from .namespaces import XML_NS
 from .namespaces import XMLNS_NS
@@ -21,10 +22,21 @@ class ElementProgram(object):
         'text': iter_text,
         }
 
+    # Modes for which the tokens are scanned (as ``(kind, start, end)``)
+    # rather than identified by the parser
+    scanners = {
+        'xml': scan_xml,
+        }
+
     def __init__(self, source, mode="xml", filename=None):
-        tokenizer = self.tokenizers[mode]
-        tokens = tokenizer(source, filename)
-        parser = ElementParser(tokens, self.DEFAULT_NAMESPACES)
+        scanner = self.scanners.get(mode)
+        if scanner is not None:
+            parser = ElementParser(
+                scanner(source), self.DEFAULT_NAMESPACES, source, filename)
+        else:
+            tokenizer = self.tokenizers[mode]
+            tokens = tokenizer(source, filename)
+            parser = ElementParser(tokens, self.DEFAULT_NAMESPACES)
 
         self.body = []
 
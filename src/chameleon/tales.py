@@ -267,6 +267,11 @@ class ImportExpr(object):
 
     def __call__(self, target, engine):
         string = self.expression.strip().replace('\n', ' ')
+
+        add_dependency = getattr(engine, 'add_dependency', None)
+        if add_dependency is not None:
+            add_dependency("import", string)
+
         value = template(
             "RESOLVE(NAME)",
             RESOLVE=Symbol(resolve_dotted),
@@ -433,14 +438,38 @@ class StringExpr(object):
 
 
 class ProxyExpr(TalesExpr):
+    """Passes the (interpolated) expression string to the function
+    ``name``.
+
+    If ``static`` is provided, a literal expression string (with no
+    interpolation) is instead passed to this function, which may then
+    cache the result.
+    """
+
     braces_required = False
 
-    def __init__(self, name, expression, ignore_prefix=True):
+    def __init__(self, name, expression, ignore_prefix=True, static=None):
         super(ProxyExpr, self).__init__(expression)
         self.ignore_prefix = ignore_prefix
         self.name = name
+        self.static = static
 
     def translate_proxy(self, engine, expression, target):
+        if self.static is not None and '$' not in expression:
+            add_dependency = getattr(engine, 'add_dependency', None)
+            if add_dependency is not None:
+                add_dependency(self.static, expression.strip())
+
+            return [
+                ast.Assign(targets=[target], value=ast.Call(
+                    func=load(self.static),
+                    args=[ast.Str(s=expression.strip())],
+                    keywords=[],
+                    starargs=None,
+                    kwargs=None
+                ))
+            ]
+
         translator = Interpolator(expression, self.braces_required)
         assignment = translator(target, engine)
 
@@ -1,13 +1,18 @@
 from __future__ import with_statement
 
 import os
+import re
 import sys
 import copy
+import bisect
 import hashlib
 import shutil
 import logging
+import threading
 import tempfile
-import inspect
+import types
+
+from time import time
 
 pkg_digest = hashlib.sha1(__name__.encode('utf-8'))
 
@@ -26,13 +31,24 @@ else:
 from .exc import TemplateError
 from .exc import ExceptionFormatter
 from .compiler import Compiler
+from .compiler import get_function_name
+from .codegen import compile_mapped
 from .config import DEBUG_MODE
+from .config import PRODUCTION_MODE
 from .config import AUTO_RELOAD
+from .config import PROFILE_MODE
 from .config import EAGER_PARSING
 from .config import CACHE_DIRECTORY
+from .config import CACHE_MAX_ENTRIES
+from .config import CACHE_MAX_BYTES
+from .config import BUNDLE_FILE
+from .loader import BundleLoader
 from .loader import ModuleLoader
 from .loader import MemoryLoader
 from .nodes import Module
+from .nodes import UseInternalMacro
+from .astutil import Node
+from .tokenize import Token
 from .utils import DebuggingOutputStream
 from .utils import Scope
 from .utils import join
@@ -41,10 +57,27 @@ from .utils import create_formatted_exception
 from .utils import read_bytes
 from .utils import raise_with_traceback
 from .utils import byte_string
+from .utils import string_type
+from .utils import ast
+from .utils import hooks
+from .utils import notify
+
+# Instrumentation hooks are managed using these functions; events are
+# ``"cook-start"``, ``"cook-end"``, ``"render-start"``,
+# ``"render-end"``, ``"macro-enter"``, ``"macro-exit"``,
+# ``"slot-enter"``, ``"slot-exit"``, ``"cache-hit"`` and
+# ``"cache-miss"``.
+from .utils import add_hook
+from .utils import remove_hook
 
 
 log = logging.getLogger('chameleon.template')
 
+try:
+    number_types = (bool, int, long, float, complex)
+except NameError:
+    number_types = (bool, int, float, complex)
+
 
 def _make_module_loader():
     remove = False
@@ -54,7 +87,128 @@ def _make_module_loader():
         path = tempfile.mkdtemp()
         remove = True
 
-    return ModuleLoader(path)
+    return ModuleLoader(
+        path, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES)
+
+
+def _read_module_source(filename):
+    """Return source code of a module written by the module loader
+    (without the encoding declaration)."""
+
+    with open(filename, 'rb') as f:
+        source = f.read().decode('utf-8')
+
+    if source.startswith('# -*- coding:'):
+        source = source.split('\n', 1)[1]
+
+    return source
+
+
+def _move_locations(table, offset):
+    """Return location table (see ``TemplateCodeGenerator``) with
+    template lines moved by ``offset``."""
+
+    if not offset:
+        return table
+
+    name, entries = table
+    return name, tuple(
+        entry[:2] + (entry[2] + offset, ) + entry[3:] for entry in entries
+        )
+
+
+class NodeDigest(object):
+    """Digest of a program node tree.
+
+    This includes the template source location of each token since
+    it's compiled into the code (for error reporting).
+
+    If ``macros`` is provided, the use of a macro which may be inlined
+    includes the macro's node tree.
+
+    If ``relative`` is set, line numbers are relative to that of the
+    first token (recorded as ``line``) such that the digest does not
+    change when the node tree is moved in the template source.
+    """
+
+    line = None
+
+    def __init__(self, sha, macros=None, relative=False):
+        self.sha = sha
+        self.macros = macros
+        self.relative = relative
+        self.lines = {}
+        self.seen = set()
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+    def update(self, value):
+        if isinstance(value, Token):
+            line, column = self.get_location(value)
+            if self.relative:
+                if self.line is None:
+                    self.line = line
+                line -= self.line
+            self.write("%s:%d:%d:" % (value.filename, line, column))
+            self.write(value)
+        elif isinstance(value, (string_type, byte_string)):
+            self.write(value)
+        elif isinstance(value, (list, tuple)):
+            self.write("[")
+            for item in value:
+                self.update(item)
+            self.write("]")
+        elif isinstance(value, dict):
+            self.write("{")
+            for key in sorted(value):
+                self.update(key)
+                self.update(value[key])
+            self.write("}")
+        elif isinstance(value, (Node, ast.AST)):
+            self.write("<%s" % type(value).__name__)
+            for name in value._fields:
+                self.update(getattr(value, name, None))
+
+            if isinstance(value, UseInternalMacro) and \
+                   self.macros is not None and value.name not in self.seen:
+                macro = self.macros.get(value.name)
+                if macro is not None:
+                    self.seen.add(value.name)
+                    self.update(macro)
+
+            self.write(">")
+        elif isinstance(value, (set, frozenset)):
+            self.write("(")
+            for item in sorted(value):
+                self.update(item)
+            self.write(")")
+        elif value is None or isinstance(value, number_types):
+            self.write(repr(value))
+        else:
+            raise TypeError(
+                "Can't compute digest of %s." % type(value).__name__)
+
+    def write(self, string):
+        if not isinstance(string, byte_string):
+            string = string.encode('utf-8', 'ignore')
+        self.sha.update(string)
+
+    def get_location(self, token):
+        if token.source is None:
+            return 0, token.pos
+
+        try:
+            source, lines = self.lines[id(token.source)]
+        except KeyError:
+            source = token.source
+            lines = [m.start() for m in re.finditer('\n', source)]
+            self.lines[id(source)] = source, lines
+
+        index = bisect.bisect_left(lines, token.pos)
+        if index == 0:
+            return 1, token.pos
+        return index + 1, token.pos - lines[index - 1] - 1
 
 
 class BaseTemplate(object):
@@ -86,6 +240,9 @@ class BaseTemplate(object):
     else:
         loader = MemoryLoader()
 
+    if BUNDLE_FILE:
+        loader = BundleLoader(BUNDLE_FILE, loader)
+
     if DEBUG_MODE:
         output_stream_factory = DebuggingOutputStream
     else:
@@ -110,9 +267,42 @@ class BaseTemplate(object):
     # time. When not set, this is only required at evaluation time.
     strict = True
 
+    # When ``template_lines`` is set, the compiled code objects refer
+    # to the template filename and line numbers instead of the
+    # generated module. This shows up in tracebacks and in external
+    # (sampling) profilers, at no cost when rendering.
+    template_lines = False
+
+    # When ``profile`` is set, the compiled template includes a table
+    # of template source locations which is used by the template
+    # profiler (see ``chameleon.profiler``); this is implied by
+    # ``template_lines``.
+    profile = PROFILE_MODE
+
+    # Macros with up to this number of elements are inlined where they
+    # are used (if the macro is known at compile time), avoiding a
+    # function call and a copy of the context. Disabled if zero.
+    inline_macros = 0
+
+    # When ``lazy_macros`` is set, each macro is compiled (and cached)
+    # separately the first time it's used. The template is parsed at
+    # most once per cook, and only if a macro is not found in the
+    # cache.
+    lazy_macros = False
+
+    # In ``production`` mode, a cooked template keeps only its render
+    # functions (and the table of source locations used to report
+    # errors). The template body and parse tree are released once
+    # they're no longer needed: with ``lazy_macros``, the body is
+    # kept to compile macros on first use, parsing it again.
+    production = PRODUCTION_MODE
+
     def __init__(self, body=None, **config):
         self.__dict__.update(config)
 
+        # Held while the template (or a render function) is cooked
+        self._cook_lock = threading.RLock()
+
         if body is not None:
             self.write(body)
 
@@ -127,6 +317,16 @@ class BaseTemplate(object):
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__, self.filename)
 
+    def __getattr__(self, name):
+        # Render functions are compiled on first use
+        if name.startswith('_render') and self.__dict__.get('_lazy'):
+            function = self._cook_function(name[1:])
+            if self.production:
+                self._program = None
+            return function
+
+        raise AttributeError(name)
+
     @property
     def keep_body(self):
         # By default, we only save the template body if we're
@@ -139,27 +339,211 @@ class BaseTemplate(object):
         # in debugging mode (to save memory).
         return self.__dict__.get('keep_source', DEBUG_MODE)
 
-    def cook(self, body):
-        digest = self._digest(body)
+    def cook(self, body, digest=None):
+        if hooks:
+            notify("cook-start", template=self)
+
+        timings = {}
+        if digest is None:
+            digest = self._digest(body)
         builtins_dict = self.builtins.copy()
         builtins_dict.update(self.extra_builtins)
-        names, builtins = zip(*builtins_dict.items())
-        program = self._cook(body, digest, names)
 
-        initialize = program['initialize']
-        functions = initialize(*builtins)
+        # Compile each macro separately
+        auto_reload = getattr(self, 'auto_reload', False)
+        split = self.lazy_macros or auto_reload
 
-        for name, function in functions.items():
-            setattr(self, "_" + name, function)
+        if split:
+            builtins_dict['__template'] = self
+
+        names, builtins = zip(*builtins_dict.items())
+
+        # Static dependencies of the compiled functions
+        self._references = set()
+
+        if split:
+            for name in tuple(self.__dict__):
+                if name.startswith('_render'):
+                    del self.__dict__[name]
+
+            self._lazy = body, digest, names, builtins, None
+            self._program = None
+
+            # With automatic reload, each macro is cached using a
+            # digest of its own nodes such that only macros which
+            # changed are compiled again.
+            if auto_reload:
+                digests = self._get_function_digests(
+                    body, digest, names, timings
+                    )
+                self._lazy = body, digest, names, builtins, digests
+
+            if not self.lazy_macros:
+                for name in self._get_function_names():
+                    self._cook_function(name)
+
+            if self.production:
+                self._program = None
+                if not self.lazy_macros:
+                    self._lazy = None
+        else:
+            self._lazy = None
+            program = self._cook(body, digest, names, timings)
+            self._initialize(program, builtins, timings)
 
         self._cooked = True
 
         if self.keep_body:
             self.body = body
 
+        if hooks:
+            notify("cook-end", template=self, timings=timings)
+
     def cook_check(self):
         assert self._cooked
 
+    def compact(self):
+        """Compile all render functions and release the data which is
+        only needed to compile them: the template body, the parse tree
+        and the generated source code.
+
+        This saves memory when a template is from then on only
+        rendered, e.g. when templates are loaded before forking worker
+        processes (see ``chameleon.preload``).
+        """
+
+        self.cook_check()
+
+        with self._cook_lock:
+            if self.__dict__.get('_lazy'):
+                for name in self._get_function_names():
+                    self._cook_function(name)
+
+                # Render functions are now all available
+                self._lazy = None
+
+            for name in ('_program', 'body', 'source'):
+                self.__dict__.pop(name, None)
+
+    def _cook_function(self, name):
+        # Another thread may be cooking the same function
+        with self._cook_lock:
+            function = self.__dict__.get("_" + name)
+            if function is None:
+                function = self._cook_function_locked(name)
+            return function
+
+    def _cook_function_locked(self, name):
+        if hooks:
+            notify("cook-start", template=self)
+
+        timings = {}
+        body, digest, names, builtins, digests = self._lazy
+        line = None
+        if digests is None:
+            digest = "%s_%s" % (digest, name)
+        elif name in digests:
+            digest, line = digests[name]
+        else:
+            raise AttributeError("_" + name)
+
+        program = self._cook(body, digest, names, timings, name, line)
+        self._initialize(program, builtins, timings)
+
+        if hooks:
+            notify("cook-end", template=self, timings=timings)
+
+        return getattr(self, "_" + name)
+
+    def _initialize(self, program, builtins, timings):
+        start = time()
+        initialize = program['initialize']
+        functions = initialize(*builtins)
+
+        for name, function in functions.items():
+            setattr(self, "_" + name, function)
+
+        self._references.update(program.get('__dependencies', ()))
+
+        timings['initialize'] = time() - start
+
+    def _get_program(self, body):
+        program = self.__dict__.get('_program')
+        if program is None:
+            program = self.parse(body)
+            if self.__dict__.get('_lazy'):
+                self._program = program
+        return program
+
+    def _get_function_digests(self, body, digest, builtins, timings):
+        """Return digest and first line of each render function.
+
+        The digest of a function does not depend on its position in
+        the template source (see ``_relocate``). The digests are
+        recorded in the metadata index of the module loader (if
+        available) such that the template is parsed only if it
+        changed.
+        """
+
+        key = None
+        if getattr(self.loader, 'get_metadata', None) is not None:
+            key = "\t".join(("functions", digest, ",".join(builtins)))
+            value = self.loader.get_metadata(key)
+            if value is not None:
+                digests = {}
+                for item in value.split("\t"):
+                    name, function_digest, line = item.split(":")
+                    digests[name] = function_digest, int(line)
+                return digests
+
+        start = time()
+        program = self._get_program(body)
+        timings['parse'] = time() - start
+
+        sha = pkg_digest.copy()
+        sha.update(type(self).__name__.encode('utf-8'))
+        sha.update(str(self.inline_macros).encode('utf-8'))
+        sha.update(",".join(builtins).encode('utf-8'))
+        if self.profile or self.template_lines:
+            sha.update("locations".encode('utf-8'))
+
+        macros = dict((macro.name, macro) for macro in program.macros)
+        digests = {}
+
+        for macro in program.macros:
+            node_digest = NodeDigest(
+                sha.copy(), macros if self.inline_macros else None, True
+                )
+            node_digest.update(macro)
+            name = get_function_name(macro.name)
+            digests[name] = (
+                "%s_%s" % (node_digest.hexdigest(), name),
+                node_digest.line or 0
+                )
+
+        if key is not None:
+            self.loader.set_metadata(key, "\t".join(
+                "%s:%s:%d" % (name, function_digest, line)
+                for name, (function_digest, line) in sorted(digests.items())
+                ))
+
+        return digests
+
+    def _get_function_names(self):
+        """Return names of the template's render functions."""
+
+        lazy = self.__dict__.get('_lazy')
+        if lazy:
+            if lazy[4] is not None:
+                return list(lazy[4])
+            program = self._get_program(lazy[0])
+            return [get_function_name(macro.name) for macro in program.macros]
+
+        return [
+            name[1:] for name in self.__dict__
+            if name.startswith('_render')
+            ]
+
     def parse(self, body):
         raise NotImplementedError("Must be implemented by subclass.")
 
@@ -168,10 +552,18 @@ class BaseTemplate(object):
         rcontext = {}
         self.cook_check()
         stream = self.output_stream_factory()
+
+        if hooks:
+            notify("render-start", template=self)
+
         try:
             self._render(stream, econtext, rcontext)
         except:
             cls, exc, tb = sys.exc_info()
+
+            if hooks:
+                notify("render-end", template=self, size=None)
+
             errors = rcontext.get('__error__')
             if errors:
                 formatter = exc.__str__
@@ -191,7 +583,12 @@ class BaseTemplate(object):
 
             raise
 
-        return join(stream)
+        result = join(stream)
+
+        if hooks:
+            notify("render-end", template=self, size=len(result))
+
+        return result
 
     def write(self, body):
         if isinstance(body, byte_string):
@@ -210,28 +607,109 @@ class BaseTemplate(object):
     def _get_module_name(self, digest):
         return "%s.py" % digest
 
-    def _cook(self, body, digest, builtins):
+    def _cook(self, body, digest, builtins, timings=None, function=None,
+              line=None):
+        if timings is None:
+            timings = {}
+
         name = self._get_module_name(digest)
+        start = time()
+        source = None
         cooked = self.loader.get(name)
         if cooked is None:
+            # Processes which share a module cache compile a template
+            # one at a time (see ``ModuleLoader.get_lock``)
+            get_lock = getattr(self.loader, 'get_lock', None)
+            lock = get_lock(name) if get_lock is not None else None
+            if lock is not None and lock.acquire():
+                # Another process may have built the module meanwhile
+                cooked = self.loader.get(name)
+
             try:
-                source = self._make(body, builtins)
-                if self.debug:
-                    source = "# template: %s\n#\n%s" % (self.filename, source)
-                if self.keep_source:
-                    self.source = source
-                cooked = self.loader.build(source, name)
-            except TemplateError:
-                exc = sys.exc_info()[1]
-                exc.filename = self.filename
-                raise
-        elif self.keep_source:
-            module = sys.modules.get(cooked.get('__name__'))
-            if module is not None:
-                self.source = inspect.getsource(module)
+                if cooked is None:
+                    # A template file is read only if its module is
+                    # not found (see ``BaseTemplateFile``)
+                    if body is None:
+                        body = self.read()
+
+                    try:
+                        source = self._make(
+                            body, builtins, timings, function)
+                        if line is not None:
+                            source = "%s\n__line = %d\n" % (source, line)
+                        if self.debug:
+                            source = "# template: %s\n#\n%s" % (
+                                self.filename, source)
+                        if self.keep_source:
+                            self.source = source
+                        start = time()
+                        cooked = self.loader.build(source, name)
+                    except TemplateError:
+                        exc = sys.exc_info()[1]
+                        exc.filename = self.filename
+                        raise
+            finally:
+                if lock is not None:
+                    lock.release()
+
+        if source is None and self.keep_source:
+            filename = cooked.get('__file__')
+            if filename is not None:
+                self.source = _read_module_source(filename)
             else:
                 self.source = None
 
+        # The function may have been compiled at another position in
+        # the template source
+        offset = 0
+        if line is not None:
+            offset = line - cooked.get('__line', line)
+
+        if self.template_lines and '__locations' in cooked:
+            # The source is not available for a module loaded from a
+            # bundle
+            if source is None and '__file__' in cooked:
+                source = _read_module_source(cooked['__file__'])
+
+            if source is not None:
+                code = compile_mapped(source, _move_locations(
+                    cooked['__locations'], offset
+                    ))
+                cooked = {}
+                exec(code, cooked)
+
+        if offset:
+            cooked = self._relocate(cooked, offset)
+
+        timings['load'] = time() - start
+
+        return cooked
+
+    def _relocate(self, cooked, offset):
+        """Return module namespace of a render function which was
+        compiled ``offset`` lines before (or after) its position in the
+        template source.
+
+        The module is shared with other templates; the line numbers
+        reported for errors are adjusted using a copy of the namespace.
+        """
+
+        cooked = dict(cooked)
+        cooked['__line_offset'] = cooked.get('__line_offset', 0) + offset
+        if '__locations' in cooked:
+            cooked['__locations'] = _move_locations(
+                cooked['__locations'], offset
+                )
+
+        initialize = cooked['initialize']
+        try:
+            code = initialize.__code__
+        except AttributeError:
+            code = initialize.func_code
+        cooked['initialize'] = types.FunctionType(
+            code, cooked, initialize.__name__
+            )
+
         return cooked
 
     def _digest(self, body):
@@ -239,16 +717,45 @@ class BaseTemplate(object):
         sha = pkg_digest.copy()
         sha.update(body.encode('utf-8', 'ignore'))
         sha.update(class_name)
+        if self.inline_macros:
+            sha.update(str(self.inline_macros).encode('utf-8'))
+        if self.profile or self.template_lines:
+            sha.update("locations".encode('utf-8'))
         return sha.hexdigest()
 
-    def _compile(self, program, builtins):
-        compiler = Compiler(self.engine, program, builtins, strict=self.strict)
+    def _compile(self, program, builtins, macros=None):
+        compiler = Compiler(
+            self.engine, program, builtins,
+            strict=self.strict, inline_macros=self.inline_macros,
+            macros=macros,
+            location_table=self.profile or self.template_lines,
+            )
         return compiler.code
 
-    def _make(self, body, builtins):
-        program = self.parse(body)
+    def _make(self, body, builtins, timings=None, function=None):
+        if timings is None:
+            timings = {}
+
+        start = time()
+        program = self._get_program(body)
+        timings['parse'] = time() - start
+
+        # Compile just the macro of the requested render function
+        macros = None
+        if function is not None:
+            for macro in program.macros:
+                if get_function_name(macro.name) == function:
+                    macros = macro.name,
+                    break
+            else:
+                raise AttributeError("_" + function)
+
+        start = time()
         module = Module("initialize", program)
-        return self._compile(module, builtins)
+        source = self._compile(module, builtins, macros)
+        timings['compile'] = time() - start
+
+        return source
 
 
 class BaseTemplateFile(BaseTemplate):
@@ -256,6 +763,12 @@ class BaseTemplateFile(BaseTemplate):
 
     Relative path names are supported only when a template loader is
     provided as the ``loader`` parameter.
+
+    If the module loader keeps a metadata index (see
+    ``ModuleLoader.get_metadata``), the digest of a template is
+    recorded using the metadata of the file. As long as this is
+    unchanged, the compiled template is then loaded without reading
+    the file.
     """
 
     # Auto reload is not enabled by default because it's a significant
@@ -280,6 +793,14 @@ class BaseTemplateFile(BaseTemplate):
             self.cook_check()
 
     def cook_check(self):
+        if self._cooked is False or (
+            self.auto_reload and self.mtime() != self._v_last_read):
+            # Only one thread cooks the template while others wait for
+            # the result
+            with self._cook_lock:
+                self._cook_check()
+
+    def _cook_check(self):
         if self.auto_reload:
             mtime = self.mtime()
 
@@ -288,10 +809,62 @@ class BaseTemplateFile(BaseTemplate):
                 self._cooked = False
 
         if self._cooked is False:
+            key, signature = self._get_metadata_key()
+            if key is not None:
+                value = self.loader.get_metadata(key)
+                if value is not None and value.startswith(signature):
+                    digest, content_type, encoding = \
+                        value[len(signature):].split('\t')
+                    self.content_type = content_type or None
+                    self.content_encoding = encoding or None
+                    log.debug("cooking %r (unchanged)..." % self.filename)
+                    self.cook(None, digest)
+                    return
+
             body = self.read()
             log.debug("cooking %r (%d bytes)..." % (self.filename, len(body)))
+            self._v_digest = None
             self.cook(body)
 
+            if key is not None and self._v_digest is not None:
+                self.loader.set_metadata(key, signature + "\t".join((
+                    self._v_digest, self.content_type or "",
+                    self.content_encoding or ""
+                    )))
+
+    def _digest(self, body):
+        # The digest is recorded in the metadata index
+        digest = self._v_digest = super(BaseTemplateFile, self)._digest(body)
+        return digest
+
+    def _get_metadata_key(self):
+        """Return key of the template file in the metadata index and
+        the signature of the file (its size, modification time and
+        inode) or ``(None, None)`` if the template must be compiled
+        from its body."""
+
+        if getattr(self.loader, 'get_metadata', None) is None:
+            return None, None
+
+        # The body is needed to compile macros separately (or kept),
+        # and inlined templates are part of the digest
+        if self.auto_reload or self.lazy_macros or self.keep_body or \
+               self.inline_macros:
+            return None, None
+
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None, None
+
+        key = "\t".join((
+            pkg_digest.hexdigest(), type(self).__name__,
+            self.default_encoding, self.filename
+            ))
+
+        signature = "%d\t%r\t%d\t" % (st.st_size, st.st_mtime, st.st_ino)
+        return key, signature
+
     def mtime(self):
         try:
             return os.path.getmtime(self.filename)
@@ -42,6 +42,163 @@ class LoadTests:
         self.assertEqual(result.filename, abs)
 
 
+    def test_cache_hooks(self):
+        import os
+        from chameleon.template import add_hook
+        from chameleon.template import remove_hook
+        here = os.path.join(os.path.dirname(__file__), "inputs")
+        loader = self._makeOne(search_path=[here])
+        events = []
+
+        def hook(event, **kwargs):
+            if kwargs.get('loader') is loader:
+                events.append((event, kwargs['name']))
+
+        add_hook(hook)
+        try:
+            self._load(loader, 'hello_world.pt')
+            self._load(loader, 'hello_world.pt')
+        finally:
+            remove_hook(hook)
+
+        self.assertEqual(events, [
+            ('cache-miss', 'hello_world.pt'),
+            ('cache-hit', 'hello_world.pt'),
+            ])
+
+
+    def test_capacity(self):
+        import os
+        here = os.path.join(os.path.dirname(__file__), "inputs")
+        loader = self._makeOne(search_path=[here], capacity=2)
+
+        first = self._load(loader, 'hello_world.pt')
+        second = self._load(loader, '001-variable-scope.pt')
+        self.assertTrue(self._load(loader, 'hello_world.pt') is first)
+
+        # The least recently used template is evicted
+        self._load(loader, '002-repeat-scope.pt')
+        stats = loader.stats
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['bytes'], sum(
+            os.path.getsize(os.path.join(here, filename))
+            for filename in ('hello_world.pt', '002-repeat-scope.pt')
+            ))
+
+        # The evicted template is still referenced and reused
+        self.assertTrue(self._load(loader, '001-variable-scope.pt') is second)
+        self.assertEqual(loader.stats['evictions'], 2)
+
+    def test_max_bytes(self):
+        import os
+        here = os.path.join(os.path.dirname(__file__), "inputs")
+        size = os.path.getsize(os.path.join(here, 'hello_world.pt'))
+        loader = self._makeOne(search_path=[here], max_bytes=size)
+        self._load(loader, 'hello_world.pt')
+        self._load(loader, '001-variable-scope.pt')
+        self.assertEqual(loader.stats['entries'], 1)
+        self.assertEqual(loader.stats['evictions'], 1)
+
+    def test_concurrent_loads(self):
+        import os
+        import threading
+        here = os.path.join(os.path.dirname(__file__), "inputs")
+        filenames = ['hello_world.pt', '001-variable-scope.pt',
+                     '002-repeat-scope.pt']
+        loader = self._makeOne(search_path=[here], capacity=2)
+        results = []
+        errors = []
+
+        def run():
+            try:
+                for i in range(200):
+                    for filename in filenames:
+                        results.append(
+                            (filename, self._load(loader, filename)))
+            except Exception:
+                import sys
+                errors.append(sys.exc_info()[1])
+
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 8 * 200 * len(filenames))
+        self.assertTrue(loader.stats['entries'] <= 2)
+
+        # Without eviction, a template is loaded only once
+        loader = self._makeOne(search_path=[here])
+        del results[:]
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(loader.stats['misses'], len(filenames))
+        for filename in filenames:
+            templates = set(
+                id(template) for name, template in results
+                if name == filename)
+            self.assertEqual(len(templates), 1)
+
+
+    def test_negative_cache(self):
+        import os
+        import shutil
+        import tempfile
+        path = tempfile.mkdtemp()
+        filename = os.path.join(path, 'hello.pt')
+
+        try:
+            mtime = os.path.getmtime(path) - 10
+            os.utime(path, (mtime, mtime))
+            loader = self._makeOne(search_path=[path])
+            self.assertRaises(ValueError, self._load, loader, 'hello.pt')
+
+            f = open(filename, 'w')
+            f.write('<div>Hello</div>')
+            f.close()
+
+            # The missing template is remembered until the directory
+            # is modified or the index is refreshed
+            os.utime(path, (mtime, mtime))
+            self.assertRaises(ValueError, self._load, loader, 'hello.pt')
+            loader.refresh()
+            self.assertEqual(self._load(loader, 'hello.pt').filename, filename)
+
+            self.assertEqual(loader.resolve('other.pt'), None)
+            f = open(os.path.join(path, 'other.pt'), 'w')
+            f.close()
+            self.assertEqual(
+                loader.resolve('other.pt'), os.path.join(path, 'other.pt'))
+
+            # The number of resolved filenames is limited
+            loader.resolve_capacity = 2
+            loader.refresh()
+            for i in range(5):
+                loader.resolve('missing-%d.pt' % i)
+            self.assertEqual(len(loader._resolved), 2)
+
+            # With automatic reload, the index is refreshed at an interval
+            loader = self._makeOne(search_path=[path], auto_reload=True)
+            loader.refresh_interval = 0
+            self.assertEqual(loader.resolve('missing.pt'), None)
+            os.rename(filename, os.path.join(path, 'missing.pt'))
+            self.assertEqual(
+                loader.resolve('missing.pt'),
+                os.path.join(path, 'missing.pt'))
+        finally:
+            shutil.rmtree(path)
+
+
 class LoadPageTests(unittest.TestCase, LoadTests):
     def _load(self, loader, filename):
         from chameleon.zpt import template
@@ -73,11 +230,301 @@ class ModuleLoadTests(unittest.TestCase):
         self.assertEqual(result1, result2)
 
         import os
-        self.assertTrue("test.py" in os.listdir(path))
+        self.assertTrue(os.path.exists(loader._get_path("test.py")))
 
         import shutil
         shutil.rmtree(path)
 
+    def test_bytecode(self):
+        import os
+        import shutil
+        import tempfile
+        from chameleon.loader import read_bytecode
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        loader = self._makeOne(path)
+        module = loader.build("value = 1", "test_bytecode.py")
+        self.assertEqual(module['value'], 1)
+
+        # The module is compiled once; the byte-code is then loaded
+        filename = loader._get_path("test_bytecode.py")
+        self.assertTrue(read_bytecode(filename) is not None)
+        f = open(filename + "c", 'rb')
+        data = f.read()
+        f.close()
+        loader.unload("test_bytecode.py")
+        self.assertEqual(loader.get("test_bytecode.py")['value'], 1)
+        f = open(filename + "c", 'rb')
+        self.assertEqual(f.read(), data)
+        f.close()
+
+        # Byte-code is ignored when the source file does not match
+        f = open(filename, 'w')
+        f.write("value = 22")
+        f.close()
+        self.assertEqual(read_bytecode(filename), None)
+        loader.unload("test_bytecode.py")
+        self.assertEqual(loader.get("test_bytecode.py")['value'], 22)
+        self.assertTrue(read_bytecode(filename) is not None)
+
+    def test_prune(self):
+        import os
+        import time
+        import shutil
+        import tempfile
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        names = ["chameleon_prune_%s.py" % name for name in "abcd"]
+        source = "value = %r" % ("x" * 100)
+
+        # The least recently used module is removed
+        loader = self._makeOne(path, max_entries=2)
+        loader.build(source, names[0])
+        lock = loader.get_lock(names[1])
+        lock.acquire()
+        loader.build(source, names[1])
+        lock.release()
+
+        # The time of last access is updated at most once an hour
+        now = time.time()
+        os.utime(loader._get_path(names[1]), (now - 60, now - 60))
+        self.assertTrue(loader.get(names[1]) is not None)
+        self.assertTrue(
+            os.path.getmtime(loader._get_path(names[1])) < now - 30)
+        os.utime(loader._get_path(names[0]), (now - 7200, now - 7200))
+        self.assertTrue(loader.get(names[0]) is not None)
+        self.assertTrue(
+            os.path.getmtime(loader._get_path(names[0])) > now - 30)
+        loader.build(source, names[2])
+        self.assertEqual(loader.stats()['entries'], 2)
+        self.assertFalse(os.path.exists(loader._get_path(names[1])))
+
+        # The lock file is kept (another process may be waiting for it)
+        from chameleon.loader import fcntl
+        if fcntl is not None:
+            self.assertTrue(os.path.exists(lock.filename))
+
+        # A module which was written before the cache was sharded
+        f = open(os.path.join(path, names[3]), 'w')
+        f.write(source)
+        f.close()
+
+        loader = self._makeOne(path)
+        now = time.time()
+        os.utime(os.path.join(path, names[3]), (now - 7200, now - 7200))
+        os.utime(loader._get_path(names[0]), (now - 60, now - 60))
+        self.assertEqual(
+            loader.prune(max_age=3600), [os.path.join(path, names[3])])
+        self.assertEqual(loader.prune(max_bytes=150), [
+            loader._get_path(names[0])])
+        self.assertEqual(loader.stats()['entries'], 1)
+
+    def test_concurrent_render(self):
+        import os
+        import sys
+        import shutil
+        import tempfile
+        import threading
+        from chameleon.zpt.template import PageTemplate
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        loader = self._makeOne(path)
+        errors = []
+
+        # The threads render overlapping sets of templates
+        def render(i):
+            try:
+                for j in range(10):
+                    n = (i + j) % 20
+                    template = PageTemplate(
+                        '<div>${%d}</div>' % n, loader=loader)
+                    result = template()
+                    if result != '<div>%d</div>' % n:
+                        errors.append(result)
+            except:
+                errors.append(sys.exc_info()[1])
+
+        threads = [
+            threading.Thread(target=render, args=(i, )) for i in range(20)
+            ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(loader.stats()['entries'], 20)
+
+    def test_compile_once(self):
+        import shutil
+        import tempfile
+        import threading
+        import time
+        from chameleon.loader import fcntl
+        from chameleon.zpt.template import PageTemplate
+
+        if fcntl is None:
+            return
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        made = []
+
+        class Template(PageTemplate):
+            def _make(self, *args):
+                made.append(self)
+                time.sleep(0.1)
+                return PageTemplate._make(self, *args)
+
+        # Each loader stands in for a process which shares the cache
+        # directory; the template is compiled by one of them only
+        templates = []
+
+        def cook():
+            templates.append(
+                Template('<div>${1 + 1}</div>', loader=self._makeOne(path)))
+
+        threads = [threading.Thread(target=cook) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(made), 1)
+        self.assertEqual(len(templates), 4)
+        for template in templates:
+            self.assertEqual(template(), '<div>2</div>')
+
+    def test_bundle(self):
+        import os
+        import shutil
+        import tempfile
+        from chameleon.loader import BundleLoader
+        from chameleon.loader import MemoryLoader
+        from chameleon.zpt.template import PageTemplate
+        from chameleon.zpt.template import PageTemplateFile
+
+        try:
+            char = unichr
+        except NameError:
+            char = chr
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        text = '<div>%s</div>' % char(230)
+        cache = os.path.join(path, 'cache')
+        os.mkdir(cache)
+        loader = self._makeOne(cache)
+        PageTemplate('<div>${1 + 1}</div>', loader=loader).cook_check()
+        PageTemplate(text, loader=loader).cook_check()
+
+        filename = os.path.join(path, 'templates.bundle')
+        self.assertEqual(loader.bundle(filename), 2)
+
+        built = []
+
+        class Fallback(MemoryLoader):
+            def build(self, source, name):
+                built.append(name)
+                return MemoryLoader.build(self, source, name)
+
+        # Templates are loaded from the bundle, others are built
+        bundle = BundleLoader(filename, Fallback())
+        self.assertEqual(len(bundle), 2)
+        template = PageTemplate('<div>${1 + 1}</div>', loader=bundle)
+        self.assertEqual(template(), '<div>2</div>')
+        template = PageTemplate(text, loader=bundle)
+        self.assertEqual(template(), text)
+        self.assertEqual(built, [])
+        template = PageTemplate('<div>${1 + 2}</div>', loader=bundle)
+        self.assertEqual(template(), '<div>3</div>')
+        self.assertEqual(len(built), 1)
+
+        # The metadata index of the fallback loader is used to find
+        # the module of an unchanged template file
+        reads = []
+
+        class Template(PageTemplateFile):
+            auto_reload = False
+
+            def read(self):
+                reads.append(self.filename)
+                return PageTemplateFile.read(self)
+
+        page = os.path.join(path, 'page.pt')
+        f = open(page, 'w')
+        f.write('<div>${2 + 2}</div>')
+        f.close()
+        self.assertEqual(Template(page, loader=loader)(), '<div>4</div>')
+        self.assertEqual(loader.bundle(filename), 3)
+
+        bundle = BundleLoader(filename, self._makeOne(cache))
+        self.assertEqual(Template(page, loader=bundle)(), '<div>4</div>')
+        self.assertEqual(reads, [page])
+        self.assertFalse(hasattr(BundleLoader(filename), 'get_metadata'))
+
+    def test_metadata(self):
+        import os
+        import shutil
+        import tempfile
+        from chameleon.zpt.template import PageTemplateFile
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = os.path.join(path, 'cache')
+        os.mkdir(cache)
+        filename = os.path.join(path, 'page.pt')
+        reads = []
+
+        class Template(PageTemplateFile):
+            # The index is not used when templates are reloaded
+            auto_reload = False
+
+            def read(self):
+                reads.append(self.filename)
+                return PageTemplateFile.read(self)
+
+        def write(body, mtime):
+            f = open(filename, 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+            os.utime(filename, (mtime, mtime))
+
+        mtime = os.path.getmtime(path)
+        write('<div>${1 + 1}</div>', mtime)
+        loader = self._makeOne(cache)
+        self.assertEqual(Template(filename, loader=loader)(), '<div>2</div>')
+        self.assertEqual(len(reads), 1)
+
+        # The file is not read while its metadata is unchanged
+        loader = self._makeOne(cache)
+        self.assertEqual(Template(filename, loader=loader)(), '<div>2</div>')
+        self.assertEqual(len(reads), 1)
+
+        # A module which is no longer found is compiled again
+        loader.prune(max_entries=0)
+        template = Template(filename, loader=loader)
+        self.assertEqual(template(), '<div>2</div>')
+        self.assertEqual(len(reads), 2)
+
+        write('<div>${1 + 2}</div>', mtime + 1)
+        template = Template(filename, loader=loader)
+        self.assertEqual(template(), '<div>3</div>')
+        self.assertEqual(len(reads), 3)
+
+        # The index is appended to and compacted when pruning
+        metadata = open(loader._get_metadata_path()).readlines()
+        self.assertEqual(len(metadata), 2)
+        loader.prune()
+        metadata = open(loader._get_metadata_path()).readlines()
+        self.assertEqual(len(metadata), 1)
+        key, signature = template._get_metadata_key()
+        self.assertTrue(loader.get_metadata(key).startswith(signature))
+
 
 class ZPTLoadTests(unittest.TestCase):
     def _makeOne(self, *args, **kwargs):
@@ -104,6 +551,119 @@ class ZPTLoadTests(unittest.TestCase):
         from chameleon.zpt.template import PageTemplateFile
         self.assertTrue(isinstance(template, PageTemplateFile))
 
+    def test_dependency_graph(self):
+        import os
+        import shutil
+        import tempfile
+        from chameleon.zpt import loader
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        for filename, body in (
+            ('layout.pt', '<div metal:define-slot="body" />'),
+            ('footer.pt', '<p>Footer</p>'),
+            ('page.pt',
+             '<div metal:use-macro="load: layout.pt">'
+             '<div metal:fill-slot="body" '
+             'tal:define="join import: os.path.join; '
+             'name string:footer.pt; '
+             'footer load: ${name}" />'
+             '</div>'),
+            ):
+            f = open(os.path.join(path, filename), 'w')
+            f.write(body)
+            f.close()
+
+        templates = loader.TemplateLoader(path)
+        page = templates.preload('page.pt')
+        self.assertTrue(page._cooked)
+        self.assertTrue(templates['page.pt'] is page)
+
+        layout = os.path.join(path, 'layout.pt')
+        filename = os.path.join(path, 'page.pt')
+
+        # The dynamic expression is not a static dependency
+        self.assertEqual(templates.get_dependencies('page.pt'), [layout])
+        self.assertEqual(templates.get_dependents('layout.pt'), [filename])
+        self.assertEqual(
+            templates.graph.get_modules(filename), ['os.path.join'])
+        self.assertTrue(page.get_dependencies()[0]._cooked)
+
+        # Invalidation cascades to the dependent templates
+        self.assertEqual(
+            templates.invalidate('layout.pt'), [layout, filename])
+        self.assertFalse(templates['page.pt'] is page)
+        self.assertEqual(templates.get_dependents('layout.pt'), [])
+
+    def test_preload(self):
+        import os
+        import shutil
+        import tempfile
+        from chameleon import preload
+        from chameleon.zpt import loader
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        os.mkdir(os.path.join(path, 'macros'))
+
+        for filename, body in (
+            ('macros/layout.html',
+             '<div metal:define-macro="layout">'
+             '<div metal:define-slot="body" /></div>'),
+            ('page.pt',
+             '<div metal:use-macro="load: macros/layout.html">'
+             '<p metal:fill-slot="body">Hello</p></div>'),
+            ('README.txt', 'Not a template.'),
+            ):
+            f = open(os.path.join(path, filename), 'w')
+            f.write(body)
+            f.close()
+
+        templates = loader.TemplateLoader(
+            path, lazy_macros=True, keep_body=True)
+        preloaded = preload(templates, "*.pt")
+        self.assertEqual(
+            [template.filename for template in preloaded],
+            [os.path.join(path, 'page.pt')])
+
+        page = preloaded[0]
+        layout = page.get_dependencies()[0]
+
+        # The templates are compiled and the data which is only needed
+        # to compile them is released
+        for template in (page, layout):
+            self.assertFalse(template.__dict__.get('_lazy'))
+            self.assertFalse('_program' in template.__dict__)
+            self.assertFalse('body' in template.__dict__)
+
+        self.assertTrue('_render_layout' in layout.__dict__)
+        self.assertEqual(page(), '<div><p>Hello</p></div>')
+
+        self.assertEqual(
+            len(preload(templates, "macros/*")), 1)
+
+        # Files which are not templates are skipped
+        import struct
+        f = open(os.path.join(path, 'logo.png'), 'wb')
+        f.write(struct.pack('6B', 0x89, 0x50, 0x4e, 0x47, 0xff, 0x00))
+        f.close()
+
+        import logging
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        log = logging.getLogger('chameleon.loader')
+        log.addHandler(handler)
+        try:
+            preloaded = preload(templates, "*")
+        finally:
+            log.removeHandler(handler)
+
+        self.assertEqual(
+            [os.path.basename(template.filename) for template in preloaded],
+            ['README.txt', 'page.pt', 'layout.html'])
+        self.assertEqual(len(records), 1)
+        self.assertTrue('logo.png' in records[0].getMessage())
+
 
 def test_suite():
     import sys
@@ -90,3 +90,82 @@ class ParserTest(TestCase):
                 diff = checker.output_difference(
                     example, got, 0)
                 self.fail("(%s) - \n%s" % (f.name, diff))
+
+    def test_unclosed_elements(self):
+        from ..tokenize import scan_xml
+        from ..parser import ElementParser
+        namespaces = {'xmlns': XMLNS_NS, 'xml': XML_NS}
+        body = '<div xmlns:py="%s"><br><p py:a="1">' \
+               '<img></p></div><span />' % PY_NS
+        parser = ElementParser(scan_xml(body), namespaces, body)
+        (kind, (start, end, children)), (kind, span) = tuple(parser)
+
+        # An element which is not closed is followed by its children
+        self.assertEqual([item[0] for item in children], [
+            'start_tag', 'element'])
+        self.assertEqual(children[0][1][0]['name'], 'br')
+        start, end, children = children[1][1]
+        self.assertEqual(list(start['ns_attrs'].items()), [
+            ((PY_NS, 'a'), '1')])
+        self.assertEqual(children[0][0], 'start_tag')
+
+        # Namespace declarations are scoped to the element
+        body += '<p py:b="2" />'
+        parser = ElementParser(scan_xml(body), namespaces, body)
+        self.assertRaises(KeyError, tuple, parser)
+
+    def test_attributes(self):
+        from ..tokenize import Token
+        from ..parser import match_tag
+        token = Token('<a b="1" c=\'2\'\n d=3 e />', 10)
+        attrs = match_tag(token)['attrs']
+
+        self.assertEqual([dict(attr.items()) for attr in attrs], [
+            {'space': ' ', 'name': 'b', 'eq': '=', 'quote': '"',
+             'value': '1'},
+            {'space': ' ', 'name': 'c', 'eq': '=', 'quote': "'",
+             'value': '2'},
+            {'space': '\n ', 'name': 'd', 'eq': '=', 'quote': '',
+             'value': '3'},
+            {'space': ' ', 'name': 'e', 'eq': '', 'quote': '',
+             'value': ''},
+            ])
+
+        # Attributes are tokens of the tag
+        self.assertEqual(attrs[1]['value'].pos, 22)
+        self.assertRaises(KeyError, attrs[0].__getitem__, 'suffix')
+
+    def test_attribute_tokens(self):
+        from ..tokenize import Token
+        from ..parser import parse_tag
+        token = Token('<a xmlns:x="urn:x" x:b="1" c="2" />')
+        node, namespace = parse_tag(token, {'xmlns': XMLNS_NS})
+        self.assertEqual(namespace['x'], 'urn:x')
+
+        # Only the tokens which are read are created
+        attrs = node['attrs']
+        self.assertEqual(attrs[1].tokens, [None, 'x:b', None, None, '1'])
+        self.assertEqual(attrs[2]['quote'], '"')
+        self.assertEqual(attrs[2].tokens, [None, 'c', None, '"', '2'])
+
+    def test_incremental(self):
+        from ..tokenize import scan_xml
+        from ..parser import ElementParser
+        body = '<div><p>Hello</p></div><br><span />'
+        scanned = []
+
+        def scan(body):
+            for item in scan_xml(body):
+                scanned.append(item)
+                yield item
+
+        # Items are parsed as they're consumed
+        parser = iter(ElementParser(scan(body), {'xml': XML_NS}, body))
+        for kind, args in parser:
+            break
+        self.assertEqual((kind, args[0]['name']), ('element', 'div'))
+        self.assertEqual(len(scanned), 5)
+
+        # An element which is not closed is complete at the end
+        self.assertEqual([kind for kind, args in parser], [
+            'start_tag', 'element'])
@@ -20,6 +20,15 @@ except ImportError:
 from chameleon.utils import byte_string
 
 
+def list_modules(path):
+    """Return filenames of the modules in a cache directory."""
+
+    return [
+        name for directory, dirs, names in os.walk(path)
+        for name in names if name.endswith('.py')
+        ]
+
+
 class Message(object):
     def __str__(self):
         return "message"
@@ -544,6 +553,445 @@ class ZopePageTemplatesTest(RenderTestCase):
             self.fail("Expected error.")
 
 
+    def test_static_load(self):
+        for auto_reload, count in ((False, 1), (True, 2)):
+            template = self.from_file(
+                os.path.join(self.root, 'inputs', '066-load-expression.pt'),
+                auto_reload=auto_reload,
+                )
+
+            calls = []
+
+            def load(spec, loader=template._loader):
+                calls.append(spec)
+                return loader(spec)
+
+            template._loader = load
+            self.assertEqual(template(), template())
+            self.assertEqual(calls, ['hello_world.pt'] * count)
+
+    def test_macros_are_reused(self):
+        body = '<div metal:define-macro="main">Hello world!</div>'
+        template = self.from_string(body)
+        macro = template.macros['main']
+        self.assertTrue(template.macros['main'] is macro)
+
+        template.cook(body)
+        self.assertFalse(template.macros['main'] is macro)
+
+    def test_inline_internal_macro(self):
+        body = '<div metal:define-macro="main" tal:define="name \'world\'">' \
+               'Hello ${name}!</div>'
+        expected = self.from_string(body)()
+        template = self.from_string(body, inline_macros=1)
+        self.assertEqual(template(), expected)
+        self.assertFalse('render_main(' in template.source.split(
+            'def render(')[1])
+
+        template = self.from_string(body, inline_macros=1)
+        template.cook('<div metal:define-macro="main">'
+                      '<span metal:define-slot="name" /></div>')
+        self.assertTrue('render_main(' in template.source.split(
+            'def render(')[1])
+
+    def test_lazy_macros(self):
+        from chameleon.loader import ModuleLoader
+
+        body = '<div tal:condition="False">' \
+               '<p metal:define-macro="a">A</p>' \
+               '<p metal:define-macro="b">B</p></div>' \
+               '<div metal:use-macro="macros[\'a\']" />'
+        expected = self.from_string(body)()
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        loader = ModuleLoader(path)
+
+        # The second template loads the functions from the cache
+        for i in range(2):
+            template = self.from_string(body, lazy_macros=True, loader=loader)
+            self.assertFalse('_render' in template.__dict__)
+            self.assertEqual(template(), expected)
+            self.assertTrue('_render_a' in template.__dict__)
+            self.assertFalse('_render_b' in template.__dict__)
+            self.assertEqual(template.__dict__['_program'] is None, i == 1)
+
+        self.assertEqual(sorted(template.macros.names), ['a', 'b'])
+        self.assertRaises(KeyError, template.macros.__getitem__, 'c')
+
+        modules = list_modules(path)
+        self.assertEqual(
+            sorted(name.split('_', 1)[1] for name in modules),
+            ['render.py', 'render_a.py']
+            )
+
+    def test_auto_reload_changed_macro(self):
+        from chameleon.loader import ModuleLoader
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'macros.pt')
+        loader = ModuleLoader(path)
+
+        def write(body, mtime=None):
+            f = open(filename, 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+            if mtime is not None:
+                os.utime(filename, (mtime, mtime))
+
+        body = '<div metal:define-macro="a">\n' \
+               '  <p>A</p>\n' \
+               '</div>\n' \
+               '<div metal:define-macro="b">\n' \
+               '  <p>%s</p>\n' \
+               '</div>\n'
+
+        write(body % 'B')
+        template = self.from_file(filename, auto_reload=True, loader=loader)
+        self.assertTrue('<p>B</p>' in template())
+
+        def modules():
+            return set(list_modules(path))
+
+        before = modules()
+        self.assertEqual(len(before), 3)
+
+        # Only the render function of the changed macro is compiled
+        # again
+        mtime = os.path.getmtime(filename)
+        write(body % 'C', mtime + 1)
+        self.assertTrue('<p>C</p>' in template())
+
+        added = modules() - before
+        self.assertEqual(
+            [name.split('_', 2)[2] for name in added], ['render_b.py']
+            )
+
+    def test_auto_reload_moved_macro(self):
+        from chameleon.loader import ModuleLoader
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'macros.pt')
+        loader = ModuleLoader(path)
+
+        def write(body, mtime=None):
+            f = open(filename, 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+            if mtime is not None:
+                os.utime(filename, (mtime, mtime))
+
+        body = '<div tal:condition="False">\n' \
+               '<div metal:define-macro="a">\n' \
+               '  <p>A</p>\n' \
+               '%s' \
+               '</div>\n' \
+               '<div metal:define-macro="b">\n' \
+               '  <p>${b.upper()}</p>\n' \
+               '</div>\n' \
+               '</div>\n'
+
+        write(body % '')
+        template = self.from_file(filename, auto_reload=True, loader=loader)
+        use = self.from_string(
+            '<div metal:use-macro="template.macros[\'b\']" />')
+        self.assertTrue('<p>B</p>' in use(template=template, b='b'))
+        before = set(list_modules(path))
+
+        # The macro is not compiled again when it's moved, but errors
+        # refer to its new position
+        mtime = os.path.getmtime(filename)
+        write(body % '  <p>A</p>\n', mtime + 1)
+        try:
+            use(template=template, b=None)
+        except AttributeError:
+            exc = sys.exc_info()[1]
+            self.assertTrue('(line 7: col 5)' in str(exc), str(exc))
+        else:
+            self.fail("Expected exception.")
+
+        added = set(list_modules(path)) - before
+        self.assertEqual(
+            sorted(name.split('_', 2)[2] for name in added),
+            ['render.py', 'render_a.py']
+            )
+
+    def test_concurrent_cook(self):
+        import threading
+        import time
+
+        from chameleon.loader import MemoryLoader
+
+        # The template is compiled in memory such that it's read even
+        # if a module cache is configured in the environment
+        path = os.path.join(os.path.dirname(__file__), "inputs")
+        template = self.from_file(
+            os.path.join(path, "hello_world.pt"), loader=MemoryLoader())
+        reads = []
+
+        def read(read=template.read):
+            # Give other threads a chance to start cooking
+            reads.append(None)
+            time.sleep(0.05)
+            return read()
+
+        template.read = read
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(template()))
+            for i in range(5)
+            ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The template is cooked just once
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(results)), 1)
+
+    def test_reload_frees_modules(self):
+        import gc
+        from chameleon.loader import ModuleLoader
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'page.pt')
+        cache = os.path.join(path, 'cache')
+        os.mkdir(cache)
+        loader = ModuleLoader(cache)
+
+        def write(i):
+            f = open(filename, 'w')
+            try:
+                f.write('<div tal:content="%d" />' % i)
+            finally:
+                f.close()
+            os.utime(filename, (mtime + i, mtime + i))
+
+        mtime = os.path.getmtime(path)
+        write(0)
+        template = self.from_file(filename, auto_reload=True, loader=loader)
+        self.assertEqual(template(), '<div>0</div>')
+        modules = len(sys.modules)
+        counts = []
+
+        for i in range(1, 201):
+            write(i)
+            self.assertEqual(template(), '<div>%d</div>' % i)
+            if i % 50 == 0:
+                gc.collect()
+                counts.append(len(gc.get_objects()))
+
+        # Generated modules are not registered with the module system
+        # and are freed when the template is compiled again
+        self.assertEqual(len(sys.modules), modules)
+        self.assertEqual(len(loader.modules), 1)
+        self.assertTrue(counts[-1] - counts[1] < 100, counts)
+
+    def test_production_mode(self):
+        import gc
+        from chameleon.loader import MemoryLoader
+        from chameleon.tokenize import Token
+
+        body = '<div metal:define-macro="a"><p tal:content="1">1</p></div>' \
+               '<div metal:define-macro="b"><p>${2}</p></div>' * 5
+        modules = set(
+            id(module.__dict__) for module in sys.modules.values()
+            if module is not None
+            )
+
+        def retained(template):
+            # Return size in bytes and number of tokens of the objects
+            # reachable from the template (except modules and classes)
+            seen = set()
+            pending = [template]
+            size = tokens = 0
+            while pending:
+                obj = pending.pop()
+                if id(obj) in seen or id(obj) in modules:
+                    continue
+                seen.add(id(obj))
+                if isinstance(obj, type):
+                    continue
+                size += sys.getsizeof(obj)
+                tokens += isinstance(obj, Token)
+                pending.extend(gc.get_referents(obj))
+            return size, tokens
+
+        for config in ({}, {'auto_reload': True}, {'lazy_macros': True}):
+            sizes = {}
+            for production in (False, True):
+                # Compile in memory such that a module cache configured
+                # in the environment does not skip parsing
+                template = self.from_string(
+                    body, keep_source=False, production=production,
+                    loader=MemoryLoader(), **config)
+                template()
+                template.macros['b']
+                sizes[production], tokens = retained(template)
+
+                # The template source is referenced only by tokens of
+                # the parse tree
+                if production or not config:
+                    self.assertEqual(tokens, 0)
+
+            if config:
+                self.assertTrue(sizes[True] < sizes[False] / 2, sizes)
+
+    def test_inline_static_macro(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        def write(filename, body):
+            f = open(os.path.join(path, filename), 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+
+        write('layout.pt',
+              '<div tal:define="name \'world\'">'
+              '<h1 metal:define-slot="title">Untitled</h1>'
+              '<p metal:define-slot="body" /></div>')
+        write('page.pt',
+              '<div metal:use-macro="load: layout.pt">'
+              '<p metal:fill-slot="body">Hello ${name}!</p></div>')
+
+        filename = os.path.join(path, 'page.pt')
+        expected = self.from_file(filename)()
+        template = self.from_file(filename, inline_macros=10, auto_reload=True)
+        self.assertEqual(template(), expected)
+        self.assertFalse('__macro.include(' in template.source)
+
+        # The template is cooked again when the used template changes
+        mtime = os.path.getmtime(filename)
+        write('layout.pt', '<div tal:define="name \'you\'">'
+              '<p metal:define-slot="body" /></div>')
+        os.utime(os.path.join(path, 'layout.pt'), (mtime + 1, mtime + 1))
+        self.assertEqual(template(), '<div><p>Hello you!</p></div>')
+
+        # Macros which use the template symbols are not inlined
+        write('layout.pt',
+              '<div tal:define="name template.__class__.__name__">'
+              '<p metal:define-slot="body" /></div>')
+        os.utime(os.path.join(path, 'layout.pt'), (mtime + 2, mtime + 2))
+        self.assertEqual(
+            template(), '<div><p>Hello PageTemplateFile!</p></div>')
+        self.assertTrue('__macro.include(' in template.source)
+
+        # Only macros which are used are candidates (not text which
+        # looks like the use of a macro)
+        write('other.pt',
+              '<!-- <div metal:use-macro="load: layout.pt" /> -->'
+              '<p title=\'metal:use-macro="load: layout.pt"\'>'
+              '<![CDATA[metal:use-macro="load: layout.pt"]]></p>')
+        template = self.from_file(
+            os.path.join(path, 'other.pt'), inline_macros=10)
+        template.cook_check()
+        self.assertEqual(template.get_dependencies(), [])
+
+    def test_inline_static_macro_cached(self):
+        from chameleon.loader import ModuleLoader
+        from chameleon.zpt.template import PageTemplateFile
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = os.path.join(path, 'cache')
+        os.mkdir(cache)
+
+        def write(filename, body):
+            f = open(os.path.join(path, filename), 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+
+        reads = []
+
+        class Template(PageTemplateFile):
+            def read(self):
+                reads.append(os.path.basename(self.filename))
+                return super(Template, self).read()
+
+        write('layout.pt', '<div><p metal:define-slot="body" /></div>')
+        write('page.pt',
+              '<div metal:use-macro="load: layout.pt">'
+              '<p metal:fill-slot="body">Hello</p></div>')
+
+        def render():
+            del reads[:]
+            template = Template(
+                os.path.join(path, 'page.pt'), inline_macros=10,
+                loader=ModuleLoader(cache)
+                )
+            return template()
+
+        self.assertEqual(render(), '<div><p>Hello</p></div>')
+        self.assertTrue('layout.pt' in reads)
+
+        # The inlined templates are recorded in the metadata index and
+        # not parsed again
+        self.assertEqual(render(), '<div><p>Hello</p></div>')
+        self.assertEqual(reads, ['page.pt'])
+
+        mtime = os.path.getmtime(os.path.join(path, 'page.pt'))
+        write('layout.pt', '<div><b metal:define-slot="body" /></div>')
+        os.utime(os.path.join(path, 'layout.pt'), (mtime + 1, mtime + 1))
+        self.assertEqual(render(), '<div><p>Hello</p></div>')
+        self.assertTrue('layout.pt' in reads)
+
+    def test_inline_extend_macro_chain(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        for filename, body in (
+            ('base.pt',
+             '<html><title metal:define-slot="title">Base</title>'
+             '<div metal:define-slot="header">Header</div>'
+             '<div metal:define-slot="content" />'
+             '<div metal:define-slot="footer">Footer</div></html>'),
+            ('site.pt',
+             '<html metal:extend-macro="load: base.pt">'
+             '<div metal:fill-slot="header"><ul metal:define-slot="nav" />'
+             '</div><div metal:fill-slot="footer">'
+             '[<span metal:define-slot="footer">Site</span>]</div></html>'),
+            ('section.pt',
+             '<html metal:extend-macro="load: site.pt">'
+             '<ul metal:fill-slot="nav"><li tal:repeat="i (1, 2)">${i}</li>'
+             '</ul><div metal:fill-slot="content">'
+             '<p metal:define-slot="body" /></div></html>'),
+            ('page.pt',
+             '<html metal:use-macro="load: section.pt">'
+             '<title metal:fill-slot="title">Page</title>'
+             '<p metal:fill-slot="body">Body</p></html>'),
+            ('override.pt',
+             '<html metal:use-macro="load: section.pt">'
+             '<ul metal:fill-slot="nav" />'
+             '<span metal:fill-slot="footer">Page</span></html>'),
+            ):
+            f = open(os.path.join(path, filename), 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+
+        for filename in ('page.pt', 'override.pt', 'section.pt'):
+            filename = os.path.join(path, filename)
+            expected = self.from_file(filename)()
+            template = self.from_file(filename, inline_macros=100)
+            self.assertEqual(template(), expected)
+            self.assertFalse('__macro.include(' in template.source)
+
+
 class ZopeTemplatesTestSuite(RenderTestCase):
     def setUp(self):
         self.temp_path = temp_path = tempfile.mkdtemp()
@@ -677,3 +1125,172 @@ class ZopeTemplatesTestSuite(RenderTestCase):
                 self.fail("(%s) - \n%s\n\nCode:\n%s" % (
                     input_path, diff.rstrip('\n'),
                     template.source.encode('utf-8')))
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        from chameleon.template import add_hook
+        self.events = []
+        add_hook(self.hook)
+
+    def tearDown(self):
+        from chameleon.template import remove_hook
+        remove_hook(self.hook)
+
+    def hook(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    def names(self):
+        return [event for event, kwargs in self.events]
+
+    def test_cook_and_render(self):
+        from chameleon.zpt.template import PageTemplate
+        template = PageTemplate("<div>${'Hello world!'}</div>")
+        result = template()
+
+        self.assertEqual(
+            self.names(),
+            ["cook-start", "cache-miss", "cook-end",
+             "render-start", "render-end"]
+            )
+
+        timings = self.events[2][1]['timings']
+        for phase in ('parse', 'compile', 'load', 'initialize'):
+            self.assertTrue(timings[phase] >= 0)
+
+        self.assertEqual(self.events[-1][1]['size'], len(result))
+
+    def test_render_error(self):
+        from chameleon.zpt.template import PageTemplate
+        template = PageTemplate("<div>${1 / 0}</div>")
+        self.assertRaises(ZeroDivisionError, template)
+        self.assertEqual(self.events[-1], (
+            "render-end", {'template': template, 'size': None}))
+
+    def test_macro_and_slot(self):
+        from chameleon.zpt.template import PageTemplate
+        macro = PageTemplate(
+            '<div metal:define-macro="main">'
+            '<span metal:define-slot="content" /></div>'
+            )
+        template = PageTemplate(
+            '<div metal:use-macro="macro.macros[\'main\']">'
+            '<span metal:fill-slot="content">Hello</span></div>'
+            )
+        del self.events[:]
+        template(macro=macro)
+
+        self.assertEqual(
+            self.names(),
+            ["render-start", "macro-enter", "slot-enter", "slot-exit",
+             "macro-exit", "render-end"]
+            )
+        self.assertEqual(self.events[1][1]['name'], 'main')
+        self.assertEqual(self.events[2][1]['name'], 'content')
+
+
+class ProfilerTestCase(TestCase):
+    def test_report(self):
+        from chameleon.zpt.template import PageTemplate
+        from chameleon.profiler import Profiler
+
+        body = '<ul>\n' \
+               '  <li tal:repeat="i range(100)">${str(i) * 3}</li>\n' \
+               '</ul>'
+
+        # The location table is included only if needed
+        template = PageTemplate(body)
+        self.assertFalse('__locations' in template._render.__globals__)
+
+        template = PageTemplate(body, profile=True)
+        profiler = Profiler()
+        profiler.enable()
+        try:
+            template()
+        finally:
+            profiler.disable()
+
+        report = profiler.report()
+        self.assertTrue('<string>:2:32 ${str(i) * 3}' in report, report)
+        self.assertTrue('<string>:2:2 <li' in report, report)
+
+        collapsed = profiler.collapsed()
+        self.assertTrue('<string>:2_${str(i)_*_3} ' in collapsed, collapsed)
+
+        # The profiler does not keep the template module alive
+        import gc
+        import weakref
+        env = template._render.__globals__
+        initialize = weakref.ref(env['initialize'])
+        del template, env
+        gc.collect()
+        self.assertEqual(initialize(), None)
+
+
+class NodeDigestTestCase(TestCase):
+    def _digest(self, value):
+        import hashlib
+        from chameleon.template import NodeDigest
+        digest = NodeDigest(hashlib.sha1())
+        digest.update(value)
+        return digest.hexdigest()
+
+    def test_set(self):
+        self.assertEqual(
+            self._digest(set(['a', 'b'])), self._digest(set(['b', 'a'])))
+        self.assertNotEqual(
+            self._digest(set(['a'])), self._digest(set(['b'])))
+
+    def test_unknown_type(self):
+        self.assertRaises(TypeError, self._digest, object())
+
+
+class TemplateLinesTestCase(TestCase):
+    body = (
+        '<div>\n'
+        '  <span tal:repeat="i range(3)">\n'
+        '    ${str(i)} ${1 / i}\n'
+        '  </span>\n'
+        '</div>'
+        )
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='chameleon-tests')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def assertRaisesAt(self, template, filename, line):
+        try:
+            template()
+        except ZeroDivisionError:
+            from traceback import extract_tb
+            tb = sys.exc_info()[2]
+            self.assertEqual(extract_tb(tb)[-1][:2], (filename, line))
+        else:
+            self.fail("Expected ZeroDivisionError.")
+
+    def test_string(self):
+        from chameleon.zpt.template import PageTemplate
+        template = PageTemplate(self.body, template_lines=True)
+        self.assertRaisesAt(template, '<string>', 3)
+
+    def test_file(self):
+        from chameleon.zpt.template import PageTemplateFile
+        from chameleon.loader import ModuleLoader
+
+        filename = os.path.join(self.tempdir, 'template.pt')
+        f = open(filename, 'w')
+        try:
+            f.write(self.body)
+        finally:
+            f.close()
+
+        loader = ModuleLoader(self.tempdir)
+
+        # The second template loads the module from the cache
+        for i in range(2):
+            template = PageTemplateFile(
+                filename, template_lines=True, loader=loader
+                )
+            self.assertRaisesAt(template, filename, 3)
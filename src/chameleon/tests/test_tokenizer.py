@@ -45,3 +45,22 @@ class TokenizerTest(TestCase):
 
         self.assertTrue(isinstance(token[1:], Token))
         self.assertEqual(token[1:].pos, 2)
+
+    def test_scan_xml(self):
+        from chameleon.parser import identify
+        from chameleon.tokenize import iter_xml
+        from chameleon.tokenize import scan_xml
+        body = '<?xml version="1.0"?><!DOCTYPE html><div a="1" b>' \
+               '<!-- comment --><![CDATA[ <x> ]]><?php x ?>text<br />' \
+               '</div><p'
+
+        scanned = list(scan_xml(body))
+        self.assertEqual([kind for kind, start, end in scanned], [
+            'xml_declaration', 'declaration', 'start_tag', 'comment',
+            'cdata', 'processing_instruction', 'text', 'empty_tag',
+            'end_tag', 'error'])
+
+        # The kinds are those identified for the tokens
+        self.assertEqual(scanned, [
+            (identify(token), token.pos, token.pos + len(token))
+            for token in iter_xml(body)])
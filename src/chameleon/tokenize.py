@@ -61,15 +61,45 @@ a("XML_SPE", "%(TextSE)s|%(MarkupSPE)s")
 a("XML_MARKUP_ONLY_SPE", "%(MarkupSPE)s")
 a("ElemTagSPE", "<|%(Name)s")
 
+# The same expression with a named group for each kind of token (the
+# alternatives are tried in the same order); the kind of a tag is
+# given by its end (a tag which is not closed has no named group).
+a("ElemTagKindCE",
+  "(%(Name)s)(?:(%(S)s)(%(Name)s)(((?:%(S)s)?=(?:%(S)s)?)"
+  "(?:%(AttValSE)s|%(Simple)s)|(?!(?:%(S)s)?=)))*(?:%(S)s)?"
+  "(?:(?P<empty_tag>/>)|(?P<start_tag>>))?")
+a("XML_KINDS",
+  "(?P<text>%(TextSE)s)|"
+  "(?P<comment><!--(?:%(CommentCE)s)?)|"
+  "(?P<cdata><!\\[CDATA\\[(?:%(CDATA_CE)s)?)|"
+  "(?P<declaration><!(?:DOCTYPE(?:%(DocTypeCE)s)?)?)|"
+  "(?P<xml_declaration><\\?(?=xml)(?:%(PI_CE)s)?)|"
+  "(?P<processing_instruction><\\?(?:%(PI_CE)s)?)|"
+  "(?P<end_tag></(?:%(EndTagCE)s)?)|"
+  "<(?:%(ElemTagKindCE)s)?")
+
 re_xml_spe = re.compile(collector.res['XML_SPE'])
 re_markup_only_spe = re.compile(collector.res['XML_MARKUP_ONLY_SPE'])
+re_xml_kinds = re.compile(collector.res['XML_KINDS'])
+
+
+def scan_xml(body):
+    """Yield ``(kind, start, end)`` for each token in ``body``.
+
+    The kind is one of ``text``, ``comment``, ``cdata``,
+    ``declaration``, ``xml_declaration``, ``processing_instruction``,
+    ``end_tag``, ``empty_tag``, ``start_tag`` and ``error`` (see
+    ``parser.identify``).
+    """
+
+    for match in re_xml_kinds.finditer(body):
+        start, end = match.span()
+        yield match.lastgroup or "error", start, end
 
 
 def iter_xml(body, filename=None):
-    for match in re_xml_spe.finditer(body):
-        string = match.group()
-        pos = match.start()
-        yield Token(string, pos, body, filename)
+    for kind, start, end in scan_xml(body):
+        yield Token(body[start:end], start, body, filename)
 
 
 def iter_text(body, filename=None):
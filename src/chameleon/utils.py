@@ -83,6 +83,32 @@ entity_re = re.compile(r'&(#?)(x?)(\d{1,5}|\w{1,8});')
 
 module_cache = {}
 
+# Registered instrumentation hooks. Call sites test this list before
+# calling ``notify`` such that there's no cost when it's empty.
+hooks = []
+
+
+def add_hook(hook):
+    """Register an instrumentation hook.
+
+    The hook is called with the event name as the only positional
+    argument and event details as keyword arguments.
+    """
+
+    if hook not in hooks:
+        hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister an instrumentation hook."""
+
+    hooks.remove(hook)
+
+
+def notify(event, **kwargs):
+    for hook in tuple(hooks):
+        hook(event, **kwargs)
+
 xml_prefixes = (
     (codecs.BOM_UTF8, 'utf-8-sig'),
     (codecs.BOM_UTF16_BE, 'utf-16-be'),
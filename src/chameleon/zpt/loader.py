@@ -28,3 +28,10 @@ class TemplateLoader(BaseLoader):
         return super(TemplateLoader, self).load(filename, cls)
 
     __getitem__ = load
+
+    def preload(self, filename, format=None):
+        """Load and compile a template file and the templates it
+        depends on (see ``load``)."""
+
+        cls = self.formats[format or self.default_format]
+        return super(TemplateLoader, self).preload(filename, cls)
@@ -539,8 +539,10 @@ class MacroProgram(ElementProgram):
 
         self._interpolation.append(INTERPOLATION)
 
-        # Visit content body
-        for child in children:
+        # Visit content body; the parsed children are released as
+        # they're visited
+        for i, child in enumerate(children):
+            children[i] = None
             body.append(self.visit(*child))
 
         self._switches.pop()
@@ -3,6 +3,9 @@ try:
 except ImportError:
     from chameleon import ast25 as ast
 
+import os
+import re
+
 from functools import partial
 from os.path import dirname
 
@@ -23,8 +26,13 @@ from ..template import BaseTemplateFile
 from ..compiler import ExpressionEngine
 from ..loader import TemplateLoader
 from ..astutil import Builtin
+from ..astutil import copy
+from ..astutil import walk
+from .. import nodes
 from ..utils import decode_string
 from ..utils import string_type
+from ..utils import hooks
+from ..utils import notify
 
 from .program import MacroProgram
 
@@ -34,6 +42,17 @@ except NameError:
     bytes = str
 
 
+# Macro use or extension with a literal ``load:`` expression (see
+# ``inline_macros``)
+STATIC_MACRO = re.compile(r'''\s*load:\s*([^"'$|]+?)\s*$''')
+
+# Expressions which refer to the template are not inlined
+REFERENCES = re.compile(r'\b(template|macros)\b|load:')
+
+# Fills that refer to compiler aliases are not inlined
+ALIASES = re.compile(r'\b(attrs|default)\b')
+
+
 class PageTemplate(BaseTemplate):
     """Constructor for the page template language.
 
@@ -128,6 +147,28 @@ class PageTemplate(BaseTemplate):
 
         If set, additional attribute whitespace will be stripped.
 
+      ``inline_macros``
+
+        Macros with up to this number of elements are rendered
+        directly where they are used instead of through a function
+        call, if the macro is known at compile time. This applies to
+        macros defined in the same template and, for file-based
+        templates, to templates used with a literal ``load:``
+        expression, e.g. ``metal:use-macro="load: footer.pt"``.
+
+        Inlined macros do not notify the ``macro-enter`` and
+        ``macro-exit`` hooks. Disabled by default.
+
+      ``lazy_macros``
+
+        If set, each macro is compiled the first time it's used
+        (rather than all macros when the template is cooked) and
+        cached as a separate module. This is useful for large macro
+        libraries of which only a few macros are used by a page.
+
+        Note that compilation errors are then raised when the macro
+        is first used.
+
     Output is unicode on Python 2 and string on Python 3.
     """
 
@@ -256,9 +297,26 @@ class PageTemplate(BaseTemplate):
 
         return super(PageTemplate, self).render(**vars)
 
+    def get_imports(self):
+        """Return names imported using a literal ``import:``
+        expression.
+
+        With ``lazy_macros``, this includes only the macros compiled
+        so far.
+        """
+
+        self.cook_check()
+        return sorted(
+            name for kind, name in self._references if kind == "import"
+            )
+
     def include(self, *args, **kwargs):
         self.cook_check()
-        self._render(*args, **kwargs)
+        if hooks:
+            include = instrumented(self, None, self._render)
+            include(*args, **kwargs)
+        else:
+            self._render(*args, **kwargs)
 
     def _builtins(self):
         return {
@@ -314,13 +372,21 @@ class PageTemplateFile(PageTemplate, BaseTemplateFile):
     expression_types = PageTemplate.expression_types.copy()
     expression_types['load'] = partial(
         ProxyExpr, '__loader',
-        ignore_prefix=False
+        ignore_prefix=False,
+        static='__load_static',
     )
 
     prepend_relative_search_path = True
 
     def __init__(self, filename, search_path=None, loader_class=TemplateLoader,
                  **config):
+        # Templates loaded using a literal path spec
+        self._static = {}
+
+        # Templates which are inlined (see ``inline_macros``)
+        self._inlined = {}
+        self._dependencies = []
+
         super(PageTemplateFile, self).__init__(filename, **config)
 
         if search_path is None:
@@ -344,11 +410,294 @@ class PageTemplateFile(PageTemplate, BaseTemplateFile):
         # class, providing the same keyword arguments.
         self._loader = loader.bind(template_class)
 
+    def mtime(self):
+        mtime = super(PageTemplateFile, self).mtime()
+        for template in self._dependencies:
+            mtime = max(mtime, template.mtime())
+        return mtime
+
+    def cook(self, body, digest=None):
+        self._inlined = None
+        self._dependencies = []
+
+        if self.inline_macros and body is not None and digest is None:
+            digest = self._get_inlined_digest(body)
+
+        try:
+            super(PageTemplateFile, self).cook(body, digest)
+        finally:
+            self._v_parsed = None
+
+    def parse(self, body):
+        # The body may have been parsed already to find the templates
+        # which are inlined
+        parsed = getattr(self, '_v_parsed', None)
+        if parsed is not None and parsed[0] is body:
+            program = parsed[1]
+            self._v_parsed = None
+        else:
+            program = super(PageTemplateFile, self).parse(body)
+
+        if self._inlined is None:
+            self._inlined = {}
+            if self.inline_macros:
+                self._inlined = self._find_inlined(program)
+
+        if self._inlined:
+            self._inline(program, self._inlined, (self.filename, ))
+        return program
+
+    def _get_inlined_digest(self, body):
+        """Return digest of the template and the templates which are
+        inlined.
+
+        The templates which may be inlined are found in the parse
+        tree. If the module loader keeps a metadata index, they're
+        recorded such that the template is parsed again only if one of
+        them changed.
+        """
+
+        key = None
+        if getattr(self.loader, 'get_metadata', None) is not None:
+            key = "\t".join((
+                "inlined", self.filename, self._digest(body)))
+            value = self.loader.get_metadata(key)
+            if value is not None:
+                fields = value.split("\t")
+                filenames = fields[1::2]
+                for filename, signature in zip(filenames, fields[2::2]):
+                    if self._get_signature(filename) != signature:
+                        break
+                else:
+                    try:
+                        self._dependencies = [
+                            self._loader(filename) for filename in filenames
+                            ]
+                    except ValueError:
+                        pass
+                    else:
+                        return fields[0]
+
+        program = super(PageTemplateFile, self).parse(body)
+        self._v_parsed = body, program
+        self._inlined = self._find_inlined(program)
+        dependencies = self._get_dependencies(
+            self._inlined, set([self.filename])
+            )
+
+        self._dependencies = [template for template, b in dependencies]
+        digest = self._digest("".join(
+            [body] + [b for template, b in dependencies]
+            ))
+
+        if key is not None:
+            fields = [digest]
+            for template, b in dependencies:
+                fields.append(template.filename)
+                fields.append(template._v_signature)
+            self.loader.set_metadata(key, "\t".join(fields))
+
+        return digest
+
+    def _get_signature(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return ""
+        return "%d:%r" % (st.st_size, st.st_mtime)
+
+    def _find_inlined(self, program):
+        inlined = {}
+        for macro in program.macros:
+            for node in walk(macro):
+                if not isinstance(node, nodes.UseExternalMacro):
+                    continue
+
+                match = STATIC_MACRO.match(node.expression.value)
+                if match is None or match.group(1) in inlined:
+                    continue
+
+                spec = match.group(1)
+                try:
+                    template = self._load_static(spec)
+                except ValueError:
+                    continue
+                if type(template) is type(self):
+                    inlined[spec] = template
+        return inlined
+
+    def _get_dependencies(self, inlined, seen):
+        dependencies = []
+        for spec in sorted(inlined):
+            template = inlined[spec]
+            if template.filename in seen:
+                continue
+            seen.add(template.filename)
+
+            # The signature is taken before the file is read
+            template._v_signature = self._get_signature(template.filename)
+            body = template.read()
+            dependencies.append((template, body))
+            program = super(PageTemplateFile, template).parse(body)
+            dependencies.extend(template._get_dependencies(
+                template._find_inlined(program), seen
+                ))
+        return dependencies
+
+    def _inline(self, program, inlined, seen):
+        uses = []
+        defined = set()
+        filled = {}
+
+        for macro in program.macros:
+            slots = set()
+            for node in walk(macro):
+                if isinstance(node, nodes.UseExternalMacro):
+                    uses.append((node, slots))
+                elif isinstance(node, nodes.DefineSlot):
+                    slots.add(node.name)
+                elif isinstance(node, nodes.FillSlot):
+                    filled[node.name] = filled.get(node.name, 0) + 1
+            defined |= slots
+
+        for node, slots in uses:
+            match = STATIC_MACRO.match(node.expression.value)
+            if match is None:
+                continue
+
+            template = inlined.get(match.group(1))
+            if template is None or template.filename in seen:
+                continue
+
+            # The template is parsed again; nodes are not shared
+            # between the inlined copies.
+            sequence = template._parse_inlined(seen)
+            if sequence is not None and self._splice(
+                sequence, node, slots, defined, filled):
+                copy(sequence, node)
+
+    def _parse_inlined(self, seen):
+        program = super(PageTemplateFile, self).parse(self.read())
+        self._inline(
+            program, self._find_inlined(program), seen + (self.filename, )
+            )
+
+        # The template must render the same in the context of the
+        # using template.
+        for node in walk(nodes.Sequence(list(program.macros))):
+            if isinstance(node, (nodes.UseExternalMacro,
+                                 nodes.UseInternalMacro,
+                                 nodes.Domain)):
+                return
+            if type(node) is nodes.Text:
+                continue
+            for field in ('value', 'source'):
+                value = getattr(node, field, None)
+                if isinstance(value, string_type) and \
+                       REFERENCES.search(value):
+                    return
+
+        return nodes.Sequence(program.body)
+
+    def _splice(self, sequence, use, function_slots, defined, filled):
+        slots = {}
+        elements = 0
+        for node in walk(sequence):
+            if isinstance(node, nodes.DefineSlot):
+                if node.name in slots:
+                    return False
+                slots[node.name] = node
+            elif isinstance(node, nodes.Element):
+                elements += 1
+
+        if elements > self.inline_macros:
+            return False
+
+        # Each fill must go to exactly one slot
+        fills = dict((fill.name, fill) for fill in use.slots)
+        if len(fills) < len(use.slots) or set(fills) - set(slots):
+            return False
+
+        for fill in use.slots:
+            for node in walk(fill.node):
+                for field in node._fields:
+                    value = getattr(node, field, None)
+                    if isinstance(value, string_type) and \
+                           ALIASES.search(value):
+                        return False
+
+        # Slots which remain are resolved on entry of the function in
+        # which they're inlined; such a slot must be the only slot by
+        # that name in the using template.
+        remaining = set()
+        for name in slots:
+            if name not in fills:
+                if name in defined or name in filled:
+                    return False
+                remaining.add(name)
+
+            # When extending a macro, a fill can be overridden by the
+            # user of the extending macro, unless the extending macro
+            # defines the slot itself.
+            elif use.extend and name not in function_slots:
+                if name in defined or filled[name] > 1:
+                    return False
+                remaining.add(name)
+
+        for name, fill in fills.items():
+            if name in remaining:
+                slots[name].node = fill.node
+            else:
+                copy(fill.node, slots[name])
+
+        defined.update(remaining)
+        return True
+
+    def get_dependencies(self):
+        """Return templates which the template depends on.
+
+        These are the templates loaded using a literal ``load:``
+        expression (e.g. to use a macro) and templates which are
+        inlined. Note that templates which are not found are left
+        out. With ``lazy_macros``, this includes only the macros
+        compiled so far.
+        """
+
+        self.cook_check()
+
+        templates = list(self._dependencies)
+        for kind, spec in sorted(self._references):
+            if kind != '__load_static':
+                continue
+
+            try:
+                template = self._load_static(spec)
+            except ValueError:
+                continue
+
+            if template not in templates:
+                templates.append(template)
+
+        return templates
+
     def _builtins(self):
         d = super(PageTemplateFile, self)._builtins()
         d['__loader'] = self._loader
+        d['__load_static'] = self._load_static
         return d
 
+    def _load_static(self, spec):
+        # The template is resolved only once, unless templates are
+        # reloaded automatically (the template search path may change)
+        if self.auto_reload:
+            return self._loader(spec)
+
+        try:
+            return self._static[spec]
+        except KeyError:
+            template = self._static[spec] = self._loader(spec)
+            return template
+
 
 class PageTextTemplate(PageTemplate):
     """Text-based template class.
@@ -374,6 +723,39 @@ class PageTextTemplateFile(PageTemplateFile):
         return result.encode(self.encoding or 'utf-8')
 
 
+def instrumented(template, name, render):
+    """Wraps macro render function to notify instrumentation hooks
+    when entering and leaving the macro and any filled slots."""
+
+    def include(stream, econtext, rcontext, *args, **kwargs):
+        for key, value in econtext.items():
+            if key.startswith('__slot_'):
+                for i in range(len(value)):
+                    fill = value[i]
+                    if not getattr(fill, 'instrumented', False):
+                        value[i] = instrumented_slot(key[7:], fill)
+
+        notify("macro-enter", template=template, name=name)
+        try:
+            render(stream, econtext, rcontext, *args, **kwargs)
+        finally:
+            notify("macro-exit", template=template, name=name)
+
+    return include
+
+
+def instrumented_slot(name, fill):
+    def wrapper(*args, **kwargs):
+        notify("slot-enter", name=name)
+        try:
+            fill(*args, **kwargs)
+        finally:
+            notify("slot-exit", name=name)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
 class Macro(object):
     __slots__ = "include",
 
@@ -382,10 +764,11 @@ class Macro(object):
 
 
 class Macros(object):
-    __slots__ = "template",
+    __slots__ = "template", "cache"
 
     def __init__(self, template):
         self.template = template
+        self.cache = {}
 
     def __getitem__(self, name):
         name = name.replace('-', '_')
@@ -397,14 +780,22 @@ class Macros(object):
             raise KeyError(
                 "Macro does not exist: '%s'." % name)
 
-        return Macro(function)
+        if hooks:
+            return Macro(instrumented(self.template, name, function))
+
+        # The macro object is reused until the template is cooked again
+        macro = self.cache.get(name)
+        if macro is None or macro.include is not function:
+            macro = self.cache[name] = Macro(function)
+
+        return macro
 
     @property
     def names(self):
         self.template.cook_check()
 
         result = []
-        for name in self.template.__dict__:
-            if name.startswith('_render_'):
-                result.append(name[8:])
+        for name in self.template._get_function_names():
+            if name.startswith('render_'):
+                result.append(name[7:])
         return result